@@ -0,0 +1,100 @@
+#!/usr/bin/python
+"""Benchmarks for the scan and storage hot paths.
+
+Runs against the Facebook posts in my_extra_posts_json.tar.bz2. Doesn't need App
+Engine, so it simulates the relevant steps instead of calling the handlers.
+
+Usage: python benchmark.py
+"""
+
+__author__ = ['Ryan Barrett <freedom@ryanb.org>']
+
+import json
+import os
+import tarfile
+import timeit
+
+import storage
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'my_extra_posts_json.tar.bz2')
+
+# Facebook's default page size
+PAGE_SIZE = 25
+REPEAT = 20
+
+
+def load_posts():
+  """Returns the decoded Facebook posts in the corpus."""
+  tar = tarfile.open(CORPUS)
+  try:
+    return json.load(tar.extractfile('posts.json.orig'))['data']
+  finally:
+    tar.close()
+
+
+def time_per_page(fn, posts):
+  """Runs fn(posts) REPEAT times and returns the best time per page in ms."""
+  secs = min(timeit.repeat(lambda: fn(posts), number=1, repeat=REPEAT))
+  return secs * 1000 * PAGE_SIZE / len(posts)
+
+
+def scan_serialize_and_reparse(posts):
+  """The old scan data flow.
+
+  get_posts() serialized every post into json_data, then Scan called
+  to_activity(), which parsed it again.
+  """
+  for post in posts:
+    json_data = json.dumps(post)
+    json.loads(json_data)
+
+
+def scan_parse_once(posts):
+  """Posts are serialized to JSON once, when saved."""
+  for post in posts:
+    json.dumps(post)
+
+
+def scan_encode_once(posts):
+  """The current scan data flow.
+
+  Posts are encoded once, when saved, with the default storage codec, so this
+  includes the CPU cost of compressing them on every put.
+  """
+  for post in posts:
+    storage.encode(post)
+
+
+def bench_scan_data_flow(posts):
+  print 'Scan data flow, serialization CPU per page of %d posts:' % PAGE_SIZE
+  for fn in scan_serialize_and_reparse, scan_parse_once, scan_encode_once:
+    print '  %-30s %6.2f ms' % (fn.__name__, time_per_page(fn, posts))
+
+
+def bench_storage_codecs(posts):
+  """Compares Migratable data size and CPU for each storage codec."""
+  legacy = sum(len(json.dumps(post)) for post in posts)
+  print 'Storage codecs, per page of %d posts:' % PAGE_SIZE
+  print '  %-30s %9s %8s %9s %9s' % ('', 'bytes', 'ratio', 'encode', 'decode')
+  print '  %-30s %9d %7.0f%%' % ('legacy json_data',
+                                 legacy * PAGE_SIZE / len(posts), 100)
+
+  for codec in storage.CODECS:
+    encoded = [storage.encode(post, codec=codec.name) for post in posts]
+    size = sum(len(e) for e in encoded)
+    encode_ms = time_per_page(
+      lambda posts: [storage.encode(p, codec=codec.name) for p in posts], posts)
+    decode_ms = time_per_page(lambda encoded: map(storage.decode, encoded),
+                              encoded)
+    print '  %-30s %9d %7.0f%% %6.2f ms %6.2f ms' % (
+      codec.name, size * PAGE_SIZE / len(posts), 100.0 * size / legacy,
+      encode_ms, decode_ms)
+
+
+if __name__ == '__main__':
+  posts = load_posts()
+  print 'Loaded %d posts from %s\n' % (len(posts), os.path.basename(CORPUS))
+  bench_scan_data_flow(posts)
+  print
+  bench_storage_codecs(posts)
@@ -21,11 +21,11 @@ import logging
 import os
 import re
 import urllib
-import urllib2
 import urlparse
 
 from activitystreams import activitystreams
 import appengine_config
+import mediacache
 import models
 from webutil import util
 
@@ -110,15 +110,11 @@ class Blogger(models.Destination):
     image = obj.get('image', {})
     image_url = image.get('url')
     if obj.get('objectType') == 'photo' and image_url:
-      logging.info('Downloading %s', image_url)
-      resp = urllib2.urlopen(image_url)
-      data = resp.read()
-      logging.debug('downloaded %d bytes', len(data))
       filename = os.path.basename(urlparse.urlparse(image_url).path)
-      mime_type = resp.info().gettype()
-      logging.info('Sending uploadFile: %s %s', mime_type, filename)
-      upload = xmlrpc.upload_file(filename, mime_type, data)
-      image['url'] = upload['url']
+      def upload_file(media):
+        logging.info('Sending uploadFile: %s %s', media.mime_type, filename)
+        return xmlrpc.upload_file(filename, media.mime_type, media.data)['url']
+      image['url'] = mediacache.upload(self, image_url, upload_file)
 
     # post!
     # http://codex.blogger.org/XML-RPC_Blogger_API/Posts#wp.newPost
@@ -15,18 +15,21 @@ import StringIO
 import urllib
 
 import appengine_config
+import mediacache
 from python_dropbox.client import DropboxOAuth2Flow, DropboxClient
+from python_dropbox.rest import ErrorResponse
 import models
 from webob import exc
 from webutil import util
 
-from google.appengine.api import urlfetch
 from google.appengine.ext import db
 from google.appengine.ext.webapp import template
 import webapp2
 
 
 TITLE_MAX_LEN = 40
+# maximum number of files to list in each folder. Dropbox's maximum.
+FILE_LIMIT = 25000
 DROPBOX_APP_KEY = appengine_config.read('dropbox_app_key')
 DROPBOX_APP_SECRET = appengine_config.read('dropbox_app_secret')
 OAUTH_CALLBACK = 'https://freedom-io-app.appspot.com/dropbox/oauth_callback'
@@ -63,8 +66,43 @@ class Dropbox(models.Destination):
     """
     return Dropbox.get_or_insert(user_id, **kwargs)
 
+  def published_marker(self, post):
+    """A post's path is its marker."""
+    return self.make_path(post, post.to_activity())
+
+  def fetch_published(self):
+    """Lists the JSON files in each source's folder.
+
+    Dropbox returns HTTP 406 for folders with more than FILE_LIMIT files, so
+    their posts are left out. publish_post() overwrites existing files, so
+    they're just published again.
+
+    Returns: dict mapping path without extension to itself
+    """
+    client = DropboxClient(self.oauth_token)
+    published = {}
+    for folder in client.metadata('/').get('contents', []):
+      if not folder.get('is_dir'):
+        continue
+      try:
+        files = client.metadata(folder['path'], file_limit=FILE_LIMIT)
+      except ErrorResponse, e:
+        if e.status != 406:
+          raise
+        logging.warning('%s has too many files to list, skipping it',
+                        folder['path'])
+        continue
+      for file in files.get('contents', []):
+        path, ext = os.path.splitext(file['path'])
+        if ext == '.json':
+          published[path] = path
+    return published
+
   def publish_post(self, post):
-    """Writes a post to a file in Dropbox"""
+    """Writes a post to a file in Dropbox.
+
+    Returns: string, the path of the post's files, without extension
+    """
     activity = post.to_activity()
     path = self.make_path(post, activity)
 
@@ -82,19 +120,23 @@ class Dropbox(models.Destination):
 
     image = activity['object'].get('image', {}).get('url')
     if image:
-      resp = urlfetch.fetch(image)
+      # each post gets its own copy of its image file, so only the download is
+      # cached, not the upload.
+      media = mediacache.fetch(image)
       ext = os.path.splitext(image)[-1]
-      response = client.put_file(path + ext, StringIO.StringIO(resp.content),
+      response = client.put_file(path + ext, StringIO.StringIO(media.data),
                                  overwrite=True)
       logging.info('Wrote image: %s', response)
 
+    return path
+
   def publish_comment(self, comment):
     """TODO"""
     raise NotImplementedError()
 
   def make_path(self, migratable, activity):
     """Generates the file path for a post or comment, *without* extension."""
-    source = migratable.migration.source().type_display_name()
+    source = migratable.source_name()
 
     # Extract just the date, discard time and time zone
     date = (activity.get('published', '')
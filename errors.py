@@ -0,0 +1,89 @@
+"""Classifies source and destination errors, and retry backoff.
+
+Permanent errors, e.g. bad credentials or a rejected post, fail the same way
+every time, so retrying them only burns queue capacity. Everything else, e.g.
+timeouts and server errors, is assumed to be transient.
+"""
+
+__author__ = ['Ryan Barrett <freedom@ryanb.org>']
+
+import random
+import urllib2
+import xmlrpclib
+
+import tumblpy
+import tweepy
+
+from google.appengine.api import urlfetch
+
+# HTTP status codes that won't change on retry
+PERMANENT_HTTP_CODES = frozenset((400, 401, 403, 404, 405, 410, 413, 414))
+
+# backoff() starts at BACKOFF_BASE_SECS and doubles up to BACKOFF_MAX_SECS
+BACKOFF_BASE_SECS = 10
+BACKOFF_MAX_SECS = 60 * 60
+
+
+class RateLimited(Exception):
+  """Raised when a destination's rate limiter makes us wait too long.
+
+  Transient, but it's not the destination's fault, so callers should retry
+  after retry_secs without counting it as a failed attempt.
+
+  Attributes:
+    retry_secs: float, how long until the rate limiter should allow it
+  """
+
+  def __init__(self, message, retry_secs):
+    super(RateLimited, self).__init__(message)
+    self.retry_secs = retry_secs
+
+
+def http_status(e):
+  """Returns the HTTP status code for an exception, or None if it has none."""
+  if isinstance(e, xmlrpclib.ProtocolError):
+    return e.errcode
+  elif isinstance(e, urllib2.HTTPError):
+    return e.code
+  elif isinstance(e, tweepy.TweepError):
+    response = getattr(e, 'response', None)
+    return getattr(response, 'status', None)
+  elif isinstance(e, tumblpy.TumblpyError):
+    return getattr(e, 'error_code', None)
+
+
+def is_permanent(e):
+  """Returns True if an exception won't go away on retry, False otherwise.
+
+  Args:
+    e: Exception
+  """
+  if isinstance(e, xmlrpclib.Fault):
+    # WordPress returns faults for bad credentials, missing posts, invalid
+    # content, etc. transient server errors are ProtocolErrors instead.
+    return True
+  elif isinstance(e, tumblpy.TumblpyAuthError):
+    return True
+  elif isinstance(e, (urlfetch.InvalidURLError, urlfetch.ResponseTooLargeError)):
+    return True
+  return http_status(e) in PERMANENT_HTTP_CODES
+
+
+def describe(e):
+  """Returns a short human-readable string for an exception."""
+  return '%s: %s' % (e.__class__.__name__, e)
+
+
+def backoff(attempt):
+  """Returns how long to wait before a retry, with exponential backoff.
+
+  Includes random jitter, up to half the delay, so that tasks that failed
+  together don't all retry together.
+
+  Args:
+    attempt: integer, the number of attempts so far, starting at 0
+
+  Returns: float seconds
+  """
+  secs = min(BACKOFF_BASE_SECS * 2 ** attempt, BACKOFF_MAX_SECS)
+  return random.uniform(secs / 2.0, secs)
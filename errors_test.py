@@ -0,0 +1,37 @@
+#!/usr/bin/python
+"""Unit tests for errors.py.
+"""
+
+__author__ = ['Ryan Barrett <freedom@ryanb.org>']
+
+import unittest
+import urllib2
+import xmlrpclib
+
+import errors
+
+from google.appengine.api import urlfetch
+
+
+class ErrorsTest(unittest.TestCase):
+
+  def test_is_permanent(self):
+    for e in (xmlrpclib.Fault(403, 'Incorrect username or password.'),
+              xmlrpclib.ProtocolError('http://my/xmlrpc', 404, '', {}),
+              urllib2.HTTPError('http://my/img', 401, '', {}, None),
+              urlfetch.InvalidURLError()):
+      self.assertTrue(errors.is_permanent(e), e)
+
+    for e in (xmlrpclib.ProtocolError('http://my/xmlrpc', 503, '', {}),
+              urllib2.HTTPError('http://my/img', 500, '', {}, None),
+              urlfetch.DownloadError(),
+              ValueError()):
+      self.assertFalse(errors.is_permanent(e), e)
+
+  def test_backoff(self):
+    for attempt in range(20):
+      secs = min(errors.BACKOFF_BASE_SECS * 2 ** attempt,
+                 errors.BACKOFF_MAX_SECS)
+      backoff = errors.backoff(attempt)
+      self.assertGreaterEqual(backoff, secs / 2.0)
+      self.assertLessEqual(backoff, secs)
@@ -4,9 +4,12 @@
 
 __author__ = ['Ryan Barrett <freedom@ryanb.org>']
 
+import calendar
+import datetime
 import itertools
 import json
 import logging
+import time
 import urllib
 import urlparse
 
@@ -52,6 +55,37 @@ API_USER_URL = API_BASE + '/%(id)s?access_token=%(access_token)s'
 API_POSTS_URL = API_BASE + '/%(id)s/posts?access_token=%(access_token)s'
 
 
+# Fields of posts and comments that the activitystreams converter and
+# render_html() use. See Migratable.SCHEMA.
+# https://developers.facebook.com/docs/reference/api/post/
+USER_SCHEMA = dict.fromkeys(('id', 'name', 'category'), True)
+COMMENT_SCHEMA = dict.fromkeys(
+  ('id', 'message', 'message_tags', 'created_time', 'updated_time'), True)
+COMMENT_SCHEMA['from'] = USER_SCHEMA
+POST_SCHEMA = dict.fromkeys(
+  ('id', 'type', 'status_type', 'object_id', 'message', 'message_tags', 'story',
+   'picture', 'link', 'name', 'caption', 'description', 'source', 'place',
+   'created_time', 'updated_time'), True)
+POST_SCHEMA.update({
+  'from': USER_SCHEMA,
+  'to': {'data': USER_SCHEMA},
+  'with_tags': {'data': USER_SCHEMA},
+  'application': dict.fromkeys(('id', 'name'), True),
+  'comments': {'data': COMMENT_SCHEMA},
+  })
+
+
+def created_timestamp(post):
+  """Returns a post's created_time as a UTC Unix timestamp.
+
+  Args:
+    post: dict, decoded JSON Facebook post or comment
+  """
+  # created_time is always UTC, e.g. '2012-05-14T05:40:23+0000'
+  return calendar.timegm(time.strptime(post['created_time'][:19],
+                                       '%Y-%m-%dT%H:%M:%S'))
+
+
 class Facebook(models.Source):
   """Implements the Facebook source.
 
@@ -59,6 +93,7 @@ class Facebook(models.Source):
   """
 
   DOMAIN = 'facebook.com'
+  EPOCH = datetime.datetime(2004, 2, 4)
 
   # full human-readable name
   name = db.StringProperty()
@@ -89,13 +124,15 @@ class Facebook(models.Source):
       picture='https://graph.facebook.com/%s/picture?type=small' % id,
       url='http://facebook.com/%s' % id)
 
-  def get_posts(self, migration, scan_url=None):
+  def get_posts(self, migration, scan_url=None, page=None, window=None):
     """Fetches a page of posts.
 
     Args:
       migration: Migration
       scan_url: string, the API URL to fetch the current page of posts. If None,
         starts at the beginning.
+      page: string, the already fetched response body for scan_url, or None
+      window: (since, until) tuple of timestamps. See Source.get_posts().
 
     Returns:
       (posts, next_scan_url). posts is a sequence of FacebookPosts.
@@ -113,10 +150,12 @@ class Facebook(models.Source):
     # Don't publish posts from these applications
     APPLICATION_BLACKLIST = ('Likes', 'Links', 'twitterfeed')
 
+    since, until = window or migration.window_timestamps()
     if not scan_url:
-      scan_url = API_POSTS_URL % {'id': self.key().name(),
-                                  'access_token': self.access_token}
-    resp = json.loads(util.urlfetch(scan_url))
+      scan_url = self.posts_url(since=since, until=until)
+    if page is None:
+      page = util.urlfetch(scan_url)
+    resp = json.loads(page)
 
     posts = []
     for post in resp['data']:
@@ -129,17 +168,57 @@ class Facebook(models.Source):
           'story' in post):
         logging.info('Skipping post %s', post.get('id'))
         continue
+      elif ((since is not None and created_timestamp(post) < since) or
+            (until is not None and created_timestamp(post) >= until)):
+        logging.info('Skipping post %s outside window', post.get('id'))
+        continue
 
       posts.append(FacebookPost(key_name_parts=(post['id'], migration.key().name()),
-                                json_data=json.dumps(post)))
+                                data=post))
 
     next_scan_url = resp.get('paging', {}).get('next')
-    # XXX remove
-    if posts and posts[-1].data()['created_time'] < '2013-09-01':
+    # posts are newest first, so once we've passed the start of the window,
+    # there's nothing left to fetch. (facebook's paging URLs don't always keep
+    # the since parameter.)
+    data = resp['data']
+    if since is not None and (not data or created_timestamp(data[-1]) < since):
       next_scan_url = None
-    # XXX
     return posts, next_scan_url
 
+  def posts_url(self, since=None, until=None):
+    """Returns the API URL for the first page of posts in a time window.
+
+    Args:
+      since: integer UTC Unix timestamp, inclusive, or None
+      until: integer UTC Unix timestamp, exclusive, or None
+    """
+    url = API_POSTS_URL % {'id': self.key().name(),
+                           'access_token': self.access_token}
+    if since is not None:
+      url += '&since=%d' % since
+    if until is not None:
+      url += '&until=%d' % until
+    return url
+
+  def resync_url(self, migration):
+    """Returns the URL for posts newer than the high-water mark."""
+    since, until = migration.window_timestamps()
+    return self.posts_url(since=max(since or 0, migration.high_water_mark),
+                          until=until)
+
+  def get_high_water_mark(self, posts):
+    """Returns the newest post's created time as a UTC Unix timestamp."""
+    times = [created_timestamp(p.data()) for p in posts
+             if p.data().get('created_time')]
+    if times:
+      return max(times)
+
+  def prefetch(self, scan_url):
+    """Starts fetching a page of posts. See Source.prefetch()."""
+    rpc = urlfetch.create_rpc(deadline=60)
+    urlfetch.make_fetch_call(rpc, scan_url)
+    return rpc
+
 
 class FacebookPost(models.Migratable):
   """A Facebook post.
@@ -148,8 +227,10 @@ class FacebookPost(models.Migratable):
   """
 
   TYPE = 'post'
+  SCHEMA = POST_SCHEMA
+  ACTIVITY_VERSION = 1
 
-  def to_activity(self):
+  def convert(self):
     """Returns an ActivityStreams activity dict for this post."""
     return as_facebook.Facebook(None).post_to_activity(self.data())
 
@@ -158,7 +239,7 @@ class FacebookPost(models.Migratable):
     comments = self.data().get('comments', {}).get('data', [])
     migration_key = FacebookPost.migration.get_value_for_datastore(self)
     return (FacebookComment(key_name_parts=(cmt['id'], migration_key.name()),
-                            json_data=json.dumps(cmt))
+                            data=cmt)
             for cmt in comments)
 
 
@@ -169,8 +250,10 @@ class FacebookComment(models.Migratable):
   """
 
   TYPE = 'comment'
+  SCHEMA = COMMENT_SCHEMA
+  ACTIVITY_VERSION = 1
 
-  def to_activity(self):
+  def convert(self):
     """Returns an ActivityStreams activity dict for this comment."""
     obj = as_facebook.Facebook(None).comment_to_object(self.data())
     return {'object': obj}
@@ -4,6 +4,7 @@
 
 __author__ = ['Ryan Barrett <freedom@ryanb.org>']
 
+import datetime
 import json
 
 import mox
@@ -11,6 +12,7 @@ import urlparse
 
 import appengine_config
 import facebook
+import models
 import webapp2
 from webutil import testutil
 
@@ -126,6 +128,21 @@ class FacebookTest(testutil.HandlerTest):
     self.assert_equals(LINK_AND_COMMENTS_SALMON_VARS * 2,
                        self.facebook.get_salmon())
 
+  def test_get_posts_window(self):
+    self.facebook.access_token = 'my_token'
+    migration = models.Migration(key_name='Facebook x WordPress http://my/xmlrpc',
+                                 id=1, since=datetime.datetime(2013, 1, 1),
+                                 until=datetime.datetime(2014, 1, 1))
+    self.expect_urlfetch(
+      facebook.API_BASE + '/x/posts?access_token=my_token'
+        '&since=1356998400&until=1388534400',
+      json.dumps({'data': [LINK_AND_COMMENTS_JSON],
+                  'paging': {'next': 'http://next/page'}}))
+    self.mox.ReplayAll()
+
+    # the post is from before the window, so we should stop paging
+    self.assertEqual(([], None), self.facebook.get_posts(migration))
+
   def test_new(self):
     self.expect_urlfetch('https://graph.facebook.com/me?access_token=my_token',
                          json.dumps({'id': '1', 'name': 'Mr. Foo'}))
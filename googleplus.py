@@ -38,6 +38,20 @@ oauth = OAuth2Decorator(
   callback_path='/googleplus/oauth2callback')
 
 
+# Fields of activities that render_html() uses. See Migratable.SCHEMA.
+# https://developers.google.com/+/api/latest/activities
+ACTOR_SCHEMA = dict.fromkeys(('id', 'displayName', 'url', 'image'), True)
+ACTIVITY_SCHEMA = dict.fromkeys(
+  ('id', 'url', 'title', 'published', 'updated', 'verb', 'location',
+   'placeName', 'address', 'geocode', 'annotation', 'comments'), True)
+ACTIVITY_SCHEMA.update({
+  'actor': ACTOR_SCHEMA,
+  'object': dict.fromkeys(('id', 'objectType', 'content', 'url', 'attachments',
+                           'tags', 'image', 'location'), True),
+  })
+ACTIVITY_SCHEMA['object']['actor'] = ACTOR_SCHEMA
+
+
 class GooglePlus(models.Source):
   """A Google+ account. The key name is the Google+ user id."""
 
@@ -65,13 +79,15 @@ class GooglePlus(models.Source):
       picture=user['image']['url'],
       url=user['url'])
 
-  def get_posts(self, migration, scan_url=None):
+  def get_posts(self, migration, scan_url=None, page=None, window=None):
     """Fetches a page of posts.
 
     Args:
       migration: Migration
       scan_url: string, the API URL to fetch the current page of posts. If None,
         starts at the beginning.
+      page: ignored, since this source doesn't support prefetching
+      window: ignored, since this source doesn't support time windows
 
     Returns:
       (posts, next_scan_url). posts is a sequence of Migratables.
@@ -111,7 +127,7 @@ class GooglePlus(models.Source):
         continue
 
       posts.append(GooglePlusPost(key_name_parts=(str(id), migration.key().name()),
-                                  json_data=json.dumps(post)))
+                                  data=post))
 
     next_scan_url = None
     # if posts:
@@ -127,8 +143,9 @@ class GooglePlusPost(models.Migratable):
   """A post. The key name is 'POST_ID MIGRATION_KEY_NAME'."""
 
   TYPE = 'post'
+  SCHEMA = ACTIVITY_SCHEMA
 
-  def to_activity(self):
+  def convert(self):
     """Returns an ActivityStreams activity dict for this post."""
     activity = self.data()
 
@@ -145,7 +162,7 @@ class GooglePlusPost(models.Migratable):
     comments = self.data().get('comments', {}).get('data', [])
     migration_key = GooglePlusPost.migration.get_value_for_datastore(self)
     return (GooglePlusComment(key_name_parts=(c['id'], migration_key.name()),
-                              json_data=json.dumps(r))
+                              data=c)
             for c in comments)
 
 
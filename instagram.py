@@ -6,6 +6,7 @@ TODO: handle expired access tokens
 
 __author__ = ['Ryan Barrett <freedom@ryanb.org>']
 
+import datetime
 import itertools
 import json
 import logging
@@ -48,6 +49,7 @@ class Instagram(models.Source):
   """
 
   DOMAIN = 'instagram.com'
+  EPOCH = datetime.datetime(2010, 10, 6)
 
   name = db.StringProperty()  # full human-readable name
   username = db.StringProperty()
@@ -75,13 +77,15 @@ class Instagram(models.Source):
       picture=user.get('profile_picture'),
       url=user.get('website', 'http://%s/%s' % (cls.DOMAIN, username)))
 
-  def get_posts(self, migration, scan_url=None):
+  def get_posts(self, migration, scan_url=None, page=None, window=None):
     """Fetches a page of posts.
 
     Args:
       migration: Migration
       scan_url: string, the API URL to fetch the current page of posts. If None,
         starts at the beginning.
+      page: ignored, since this source doesn't support prefetching
+      window: (since, until) tuple of timestamps. See Source.get_posts().
 
     Returns:
       (posts, next_url). posts is a sequence of InstagramPosts.
@@ -93,10 +97,20 @@ class Instagram(models.Source):
                        access_token=self.access_token)
 
     user_id = self.key().name()
-    media, next_url = api.user_recent_media(user_id, with_next_url=scan_url)
+    # the time window only needs to be passed for the first page. instagram
+    # includes it in the next page URLs.
+    kwargs = {}
+    if not scan_url:
+      since, until = window or migration.window_timestamps()
+      if since is not None:
+        kwargs['min_timestamp'] = since
+      if until is not None:
+        kwargs['max_timestamp'] = until
+    media, next_url = api.user_recent_media(user_id, with_next_url=scan_url,
+                                            **kwargs)
     converter = as_instagram.Instagram(None)
     imedia = [InstagramMedia(key_name_parts=(m.id, migration.key().name()),
-                             json_data=json.dumps(converter.media_to_activity(m)))
+                             data=converter.media_to_activity(m))
               for m in media]
     return imedia, next_url
 
@@ -113,7 +127,7 @@ class InstagramMedia(models.Migratable):
 
   TYPE = 'post'
 
-  def to_activity(self):
+  def convert(self):
     """Returns an ActivityStreams activity dict for this media."""
     return self.data()
 
@@ -122,7 +136,7 @@ class InstagramMedia(models.Migratable):
     comments = self.data().get('replies', {}).get('items', [])
     migration_key = InstagramMedia.migration.get_value_for_datastore(self)
     return (InstagramComment(key_name_parts=(cmt['id'], migration_key.name()),
-                             json_data=json.dumps(cmt))
+                             data=cmt)
             for cmt in comments)
 
 
@@ -134,7 +148,7 @@ class InstagramComment(models.Migratable):
 
   TYPE = 'comment'
 
-  def to_activity(self):
+  def convert(self):
     """Returns an ActivityStreams activity dict for this comment."""
     return {'object': self.data()}
 
@@ -0,0 +1,175 @@
+"""A content-addressed cache for photos and other media that we re-upload.
+
+Media is identified by the SHA-1 hash of its contents. Three layers:
+
+  * source URL => hash, in memcache, so we can skip downloading media we've
+    already seen.
+  * hash => contents, in a size-bounded, in-process LRU cache, so retries and
+    posts that share a photo don't download it again.
+  * (destination, hash) => uploaded URL, in the datastore, so uploading the
+    same media to the same destination again is just a lookup.
+"""
+
+__author__ = ['Ryan Barrett <freedom@ryanb.org>']
+
+import collections
+import hashlib
+import logging
+import threading
+import urllib2
+
+from google.appengine.api import memcache
+from google.appengine.api import urlfetch
+from google.appengine.ext import db
+
+# urlfetch deadline for downloading media, in seconds
+DEADLINE_SECS = 60
+
+# bounds on the in-process byte store. media bigger than MAX_ITEM_BYTES is
+# downloaded and uploaded as usual but not kept.
+MAX_BYTES = 32 * 1024 * 1024
+MAX_ITEM_BYTES = 4 * 1024 * 1024
+
+Media = collections.namedtuple('Media', ('hash', 'data', 'mime_type'))
+
+
+class LRUCache(object):
+  """A thread-safe LRU cache bounded by the total size of its values.
+
+  Attributes:
+    max_bytes: integer
+    size: integer, the total size of the current values
+  """
+
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.size = 0
+    self.items = collections.OrderedDict()
+    self.lock = threading.Lock()
+
+  def get(self, key):
+    """Returns the value for a key, or None, and marks it recently used."""
+    with self.lock:
+      item = self.items.pop(key, None)
+      if item is None:
+        return None
+      self.items[key] = item
+      return item[0]
+
+  def put(self, key, value, size):
+    """Adds a value, evicting least recently used values to make room.
+
+    Args:
+      key: hashable
+      value: any value
+      size: integer, the value's size in bytes
+    """
+    if size > self.max_bytes:
+      return
+
+    with self.lock:
+      old = self.items.pop(key, None)
+      if old is not None:
+        self.size -= old[1]
+      while self.items and self.size + size > self.max_bytes:
+        _, (_, evicted_size) = self.items.popitem(last=False)
+        self.size -= evicted_size
+      self.items[key] = (value, size)
+      self.size += size
+
+  def clear(self):
+    with self.lock:
+      self.items.clear()
+      self.size = 0
+
+
+# hash => Media
+contents = LRUCache(MAX_BYTES)
+
+
+class MediaUpload(db.Model):
+  """Records media uploaded to a destination.
+
+  A root entity, so that a destination's uploads don't all land in one entity
+  group. The key name is the destination's key and the content hash.
+  """
+  url = db.StringProperty(required=True, indexed=False)
+  source_url = db.StringProperty(indexed=False)
+  created = db.DateTimeProperty(auto_now_add=True)
+
+  @staticmethod
+  def key_name_for(dest, digest):
+    return '%s %s' % (dest.key(), digest)
+
+
+def hash_cache_key(url):
+  return 'media_hash %s' % url
+
+
+def fetch(url):
+  """Returns the media at a URL, downloading it only if it's not cached.
+
+  Args:
+    url: string
+
+  Returns: Media
+  """
+  digest = memcache.get(hash_cache_key(url))
+  if digest:
+    media = contents.get(digest)
+    if media:
+      logging.debug('Using cached media for %s', url)
+      return media
+
+  logging.info('Downloading %s', url)
+  resp = urlfetch.fetch(url, deadline=DEADLINE_SECS)
+  if resp.status_code != 200:
+    # HTTPError carries the status, so errors.is_permanent() sees 404s etc.
+    raise urllib2.HTTPError(url, resp.status_code,
+                            'Fetching %s returned HTTP %s' %
+                            (url, resp.status_code),
+                            resp.headers, None)
+
+  data = resp.content
+  mime_type = resp.headers.get('Content-Type', '').split(';')[0].strip()
+  media = Media(hashlib.sha1(data).hexdigest(), data, mime_type)
+  logging.debug('downloaded %d bytes, hash %s', len(data), media.hash)
+
+  memcache.set(hash_cache_key(url), media.hash)
+  if len(data) <= MAX_ITEM_BYTES:
+    contents.put(media.hash, media, len(data))
+  return media
+
+
+def upload(dest, url, upload_fn):
+  """Uploads media to a destination, unless it's already there.
+
+  Args:
+    dest: Destination
+    url: string, the media's source URL
+    upload_fn: callable that takes a Media, uploads it to dest, and returns
+      its string URL there
+
+  Returns: string, the media's URL in the destination
+  """
+  digest = memcache.get(hash_cache_key(url))
+  if digest:
+    existing = MediaUpload.get_by_key_name(
+      MediaUpload.key_name_for(dest, digest))
+    if existing:
+      logging.info('Already uploaded %s to %s', url, existing.url)
+      return existing.url
+
+  media = fetch(url)
+  if media.hash != digest:
+    # same contents at another source URL?
+    existing = MediaUpload.get_by_key_name(
+      MediaUpload.key_name_for(dest, media.hash))
+    if existing:
+      logging.info('Already uploaded %s to %s', url, existing.url)
+      return existing.url
+
+  uploaded_url = upload_fn(media)
+  MediaUpload(key_name=MediaUpload.key_name_for(dest, media.hash),
+              url=uploaded_url, source_url=url).put()
+  return uploaded_url
@@ -0,0 +1,123 @@
+#!/usr/bin/python
+"""Unit tests for mediacache.py.
+"""
+
+__author__ = ['Ryan Barrett <freedom@ryanb.org>']
+
+import collections
+import hashlib
+import urllib2
+
+import errors
+import mediacache
+from webutil import testutil
+
+from google.appengine.api import urlfetch
+from google.appengine.ext import db
+
+FakeResponse = collections.namedtuple('FakeResponse',
+                                      ('status_code', 'content', 'headers'))
+
+
+class FakeDest(db.Model):
+  pass
+
+
+class LRUCacheTest(testutil.HandlerTest):
+
+  def test_evicts_least_recently_used(self):
+    cache = mediacache.LRUCache(10)
+    cache.put('a', 'A', 4)
+    cache.put('b', 'B', 4)
+    self.assertEqual('A', cache.get('a'))
+
+    cache.put('c', 'C', 4)
+    self.assertEqual('A', cache.get('a'))
+    self.assertIsNone(cache.get('b'))
+    self.assertEqual('C', cache.get('c'))
+    self.assertEqual(8, cache.size)
+
+  def test_too_big(self):
+    cache = mediacache.LRUCache(10)
+    cache.put('a', 'A', 11)
+    self.assertIsNone(cache.get('a'))
+    self.assertEqual(0, cache.size)
+
+
+class MediaCacheTest(testutil.HandlerTest):
+
+  def setUp(self):
+    super(MediaCacheTest, self).setUp()
+    mediacache.contents.clear()
+    self.dest = FakeDest(key_name='my blog')
+    self.dest.put()
+    self.uploads = []
+    self.mox.StubOutWithMock(urlfetch, 'fetch')
+
+  def expect_fetch(self, url, content):
+    urlfetch.fetch(url, deadline=mediacache.DEADLINE_SECS).AndReturn(
+      FakeResponse(200, content, {'Content-Type': 'image/jpeg'}))
+
+  def test_fetch_http_error(self):
+    urlfetch.fetch('http://pic', deadline=mediacache.DEADLINE_SECS).AndReturn(
+      FakeResponse(404, 'Not Found', {}))
+    self.mox.ReplayAll()
+
+    with self.assertRaises(urllib2.HTTPError) as cm:
+      mediacache.fetch('http://pic')
+    self.assertEqual(404, cm.exception.code)
+    self.assertTrue(errors.is_permanent(cm.exception))
+
+  def upload_fn(self, media):
+    self.uploads.append(media)
+    return 'http://my/blog/%d.jpg' % len(self.uploads)
+
+  def test_fetch_caches_contents(self):
+    self.expect_fetch('http://pic', 'xyz')
+    self.mox.ReplayAll()
+
+    for _ in range(2):
+      media = mediacache.fetch('http://pic')
+      self.assertEqual(hashlib.sha1('xyz').hexdigest(), media.hash)
+      self.assertEqual('xyz', media.data)
+      self.assertEqual('image/jpeg', media.mime_type)
+
+  def test_upload_dedupes_by_url(self):
+    self.expect_fetch('http://pic', 'xyz')
+    self.mox.ReplayAll()
+
+    for _ in range(2):
+      self.assertEqual('http://my/blog/1.jpg',
+                       mediacache.upload(self.dest, 'http://pic', self.upload_fn))
+    self.assertEqual(1, len(self.uploads))
+
+  def test_upload_dedupes_by_contents(self):
+    self.expect_fetch('http://pic', 'xyz')
+    self.expect_fetch('http://other/pic', 'xyz')
+    self.mox.ReplayAll()
+
+    mediacache.upload(self.dest, 'http://pic', self.upload_fn)
+    self.assertEqual('http://my/blog/1.jpg', mediacache.upload(
+        self.dest, 'http://other/pic', self.upload_fn))
+    self.assertEqual(1, len(self.uploads))
+
+  def test_upload_per_destination(self):
+    self.expect_fetch('http://pic', 'xyz')
+    self.mox.ReplayAll()
+
+    other = FakeDest(key_name='other blog')
+    other.put()
+    mediacache.upload(self.dest, 'http://pic', self.upload_fn)
+    self.assertEqual('http://my/blog/2.jpg',
+                     mediacache.upload(other, 'http://pic', self.upload_fn))
+
+  def test_upload_root_entity(self):
+    self.expect_fetch('http://pic', 'xyz')
+    self.mox.ReplayAll()
+
+    mediacache.upload(self.dest, 'http://pic', self.upload_fn)
+    digest = hashlib.sha1('xyz').hexdigest()
+    upload = mediacache.MediaUpload.get_by_key_name(
+      '%s %s' % (self.dest.key(), digest))
+    self.assertIsNone(upload.parent_key())
+    self.assertEqual('http://my/blog/1.jpg', upload.url)
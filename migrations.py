@@ -3,6 +3,7 @@
 
 __author__ = 'Ryan Barrett <freedom@ryanb.org>'
 
+import datetime
 import itertools
 import logging
 import urllib
@@ -28,6 +29,11 @@ from google.appengine.ext import db
 import webapp2
 
 
+# the initial scan of sources that support time windows is split into this many
+# parallel time slices. see models.Migration.shard_windows().
+SCAN_SHARDS = 8
+
+
 class MigrateHandler(webapp2.RequestHandler):
   """Starts a migration."""
   # TODO
@@ -37,10 +43,36 @@ class MigrateHandler(webapp2.RequestHandler):
     dest = db.Key(self.request.get('dest'))
     key_name = models.Migration.make_key_name(source.kind(), source.name(),
                                               dest.kind(), dest.name())
+    window = {}
+    for param in 'since', 'until':
+      value = self.request.get(param)
+      if value:
+        try:
+          window[param] = datetime.datetime.strptime(value, '%Y-%m-%d')
+        except ValueError:
+          raise exc.HTTPBadRequest('Invalid %s date: %s' % (param, value))
+
     id = db.allocate_ids(db.Key.from_path('Migration', 1), 1)[0]
-    migration = models.Migration.get_or_insert(key_name, id=id)
+    migration = models.Migration.get_or_insert(
+      key_name, id=id, sync=self.request.get('sync') == 'true', **window)
+
+    epoch = db.class_for_kind(source.kind()).EPOCH
+    shard_windows = (migration.shard_windows(SCAN_SHARDS, epoch) if epoch
+                     else [(None, None)])
+    migration.shards = len(shard_windows)
+    migration.shards_done = []
+    migration.save()
+
+    tasks = []
+    for shard, (since, until) in enumerate(shard_windows):
+      params = {'migration': key_name}
+      if len(shard_windows) > 1:
+        params.update({'shard': shard,
+                       'since': since if since is not None else '',
+                       'until': until if until is not None else ''})
+      tasks.append(taskqueue.Task(params=params))
+    taskqueue.Queue('scan').add(tasks)
 
-    taskqueue.add(queue_name='scan', params={'migration': key_name})
     self.redirect('/migration/%d' % migration.id)
 
 
@@ -128,8 +160,12 @@ class MigrationHandler(handlers.TemplateHandler):
         for cls in self.MIGRATABLES[source_kind]))
       for status in models.Migratable.STATUSES}
 
+    waits = models.get_samples(migration.queue_wait_samples_name())
+    queue_wait = sorted(waits)[len(waits) / 2] if waits else None
+
     return {'migration': migration,
             'migratables': migratables,
+            'queue_wait': queue_wait,
             'message': self.request.get('message')}
 
 
@@ -3,22 +3,35 @@
 
 __author__ = ['Ryan Barrett <freedom@ryanb.org>']
 
+import calendar
+import collections
 import datetime
+import hashlib
 import itertools
 import json
 import logging
+import time
 import urlparse
 
 from activitystreams import activitystreams
 import appengine_config
+import errors
+import ratelimit
+import storage
 from webutil import models
 from webutil import util
 
+from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 from google.appengine.ext import db
 import webapp2
 
 
+def to_timestamp(dt):
+  """Converts a naive UTC datetime to an integer Unix timestamp."""
+  return calendar.timegm(dt.utctimetuple())
+
+
 class Base(models.KeyNameModel):
   """A model class with a few utilities.
 
@@ -68,6 +81,11 @@ class Source(Base):
   Each concrete source type should subclass this.
   """
 
+  # datetime of the earliest possible post, in UTC. Sources that support time
+  # windows in get_posts() set this so that scans can be sharded into time
+  # slices. None means scans aren't sharded.
+  EPOCH = None
+
   url = db.LinkProperty()
   picture = db.LinkProperty()
 
@@ -83,7 +101,7 @@ class Source(Base):
     """
     raise NotImplementedError()
 
-  def get_posts(self, migration, scan_url):
+  def get_posts(self, migration, scan_url, page=None, window=None):
     """Fetches a page of Post instances using the given source API URL.
 
     To be implemented by subclasses.
@@ -91,6 +109,10 @@ class Source(Base):
     Args:
       migration: Migration
       scan_url: string, the source API URL to fetch the current page of posts
+      page: string, the already fetched response body for scan_url, e.g. from
+        prefetch(). If None, scan_url is fetched.
+      window: (since, until) tuple of integer UTC Unix timestamps or Nones, the
+        time window to scan. Defaults to migration.window_timestamps().
 
     Returns:
       (posts, next_scan_url). post is a sequence of Migratable instances,
@@ -99,6 +121,48 @@ class Source(Base):
     """
     raise NotImplementedError()
 
+  def resync_url(self, migration):
+    """Returns the source API URL for the first page of an incremental re-sync.
+
+    The URL should only return posts newer than migration.high_water_mark.
+    Defaults to None, ie the source doesn't support incremental re-syncs and
+    re-sync scans start from the beginning. May be overridden by subclasses.
+
+    Args:
+      migration: Migration, with high_water_mark set
+
+    Returns: string URL, or None
+    """
+    return None
+
+  def get_high_water_mark(self, posts):
+    """Returns the high-water mark for a page of posts.
+
+    Defaults to None, ie the source doesn't support incremental re-syncs. May be
+    overridden by subclasses.
+
+    Args:
+      posts: sequence of Migratables
+
+    Returns: integer, a source-specific mark for the newest post, e.g. a
+      timestamp or id, or None
+    """
+    return None
+
+  def prefetch(self, scan_url):
+    """Starts fetching a page of posts in the background.
+
+    The response body can later be passed to get_posts() as its page kwarg.
+    Sources that don't fetch pages by URL can't prefetch, so this defaults to
+    returning None. May be overridden by subclasses.
+
+    Args:
+      scan_url: string, the source API URL to fetch
+
+    Returns: urlfetch RPC, or None if this source doesn't support prefetching
+    """
+    return None
+
 
 class Destination(Base):
   """A web site to propagate posts to, e.g. a WordPress blog.
@@ -106,14 +170,148 @@ class Destination(Base):
   Each concrete destination class should subclass this class.
   """
 
+  # whether comments have to be published in the order they were written,
+  # e.g. because the destination orders them by when they were published.
+  ORDERED_COMMENTS = False
+  # whether publish_comments() publishes comments more efficiently than
+  # publish_comment() one at a time, e.g. in a single request
+  BATCH_COMMENTS = False
+
+  # Each destination gets its own token bucket that limits how fast posts and
+  # comments are published to it: PUBLISH_RATE per second, on average, in
+  # bursts of up to PUBLISH_BURST.
+  PUBLISH_RATE = 1
+  PUBLISH_BURST = 5
+
+  # longest to wait for the rate limiter before giving up and letting the task
+  # retry
+  MAX_RATE_LIMIT_WAIT = datetime.timedelta(seconds=10)
+
+  def rate_limiter(self):
+    """Returns the ratelimit.TokenBucket for publishing to this destination."""
+    return ratelimit.TokenBucket(str(self.key()), self.PUBLISH_RATE,
+                                 self.PUBLISH_BURST)
+
+  def wait_for_rate_limit(self):
+    """Waits for a token from rate_limiter().
+
+    Call before each publishing request to the destination.
+
+    Raises: errors.RateLimited if that would take over MAX_RATE_LIMIT_WAIT
+    """
+    wait = self.rate_limiter().wait(self.MAX_RATE_LIMIT_WAIT.total_seconds())
+    if wait:
+      raise errors.RateLimited('Rate limited by %s' % self.key(), wait)
+
+  def fetch_published(self):
+    """Fetches the posts that have already been published to this destination.
+
+    To be implemented by subclasses that store markers with their posts. This
+    is only called about once per migration, so it doesn't use the publishing
+    rate limiter. See find_published().
+
+    Returns: dict mapping published_marker() to string destination id, or None
+      if this destination doesn't support it
+    """
+    return None
+
+  def published_marker(self, post):
+    """Returns the marker that publish_post() stores with a post.
+
+    Defaults to Migratable.marker(). May be overridden by subclasses.
+
+    Args:
+      post: Migratable
+    """
+    return post.marker()
+
+  def find_published(self, post, since=None):
+    """Returns the destination id of a post if it's already been published.
+
+    Uses an index of published posts from fetch_published(). It's fetched once
+    per migration and stored in a PublishedIndex, and also cached in
+    published_indexes. It's only fetched again if it's older than since.
+
+    Args:
+      post: Migratable
+      since: datetime, optional. If provided, the index must have been fetched
+        after this, e.g. so that it includes a previous publish attempt.
+
+    Returns: string destination id, or None
+
+    Raises: errors.RateLimited if another task is fetching the index
+    """
+    key = post.migration_key_name()
+    fetched, index = published_indexes.get(key, (None, None))
+    if fetched is None or (since and fetched < since):
+      stored = PublishedIndex.get_by_key_name(key)
+      if stored and not (since and stored.fetched < since):
+        fetched, index = stored.fetched, storage.decode(stored.data)
+      else:
+        fetched, index = self.fetch_published_index(key)
+      cache_put(published_indexes, key, (fetched, index))
+
+    return index.get(self.published_marker(post))
+
+  def fetch_published_index(self, key):
+    """Fetches the index of published posts and stores it in a PublishedIndex.
+
+    Single flight: only one task fetches a migration's index at a time.
+
+    Args:
+      key: string Migration key name
+
+    Returns: (fetched datetime, dict index) tuple
+
+    Raises: errors.RateLimited if another task is already fetching it
+    """
+    lock = 'published_index_lock %s' % key
+    if not memcache.add(lock, True, time=PUBLISHED_INDEX_LOCK_SECS):
+      raise errors.RateLimited('Another task is fetching published posts for %s'
+                               % key, PUBLISHED_INDEX_LOCK_SECS)
+
+    try:
+      # before fetching, so that publishes during the fetch are after it
+      fetched = datetime.datetime.now()
+      logging.info('Fetching published posts for %s', key)
+      index = self.fetch_published()
+      if index is None:
+        return fetched, {}
+
+      data = storage.encode(index)
+      if len(data) > MAX_PUBLISHED_INDEX_BYTES:
+        logging.warning('Published index for %s is %d bytes, too big to store',
+                        key, len(data))
+      else:
+        PublishedIndex(key_name=key, fetched=fetched, data=db.Blob(data)).put()
+      return fetched, index
+    finally:
+      memcache.delete(lock)
+
+  def add_published(self, post, dest_id):
+    """Adds a newly published post to the cached index of published posts.
+
+    Only updates this instance's cache, not the PublishedIndex. Posts
+    published after the index was fetched are complete, so they're only looked
+    up again if a publish attempt died, which refetches the index anyway.
+
+    Args:
+      post: Migratable
+      dest_id: string destination id
+    """
+    fetched, index = published_indexes.get(post.migration_key_name(),
+                                           (None, None))
+    if index is not None:
+      index[self.published_marker(post)] = dest_id
+
   def publish_post(self, post):
     """Publishes a post, idempotently.
 
     To be implemented by subclasses.
 
-    In order to be idempotent, this should include the post id in the
-    destination post so that it can be queried later to see if it's
-    already been published or not.
+    In order to be idempotent, this should store published_marker() with the
+    destination post, and fetch_published() should return it, so that
+    find_published() can tell whether it's already been published or not.
 
     Args:
       post: Migratable
@@ -138,6 +336,40 @@ class Destination(Base):
     """
     raise NotImplementedError()
 
+  def publish_comments(self, comments):
+    """Publishes multiple comments, idempotently.
+
+    Defaults to calling wait_for_rate_limit() and publish_comment() for each
+    one. Subclasses that set BATCH_COMMENTS override this, and should call
+    wait_for_rate_limit() before each request.
+
+    Args:
+      comments: sequence of Migratable, in the order to publish them
+
+    Returns: list with the destination id of each comment, or the exception it
+      failed with
+    """
+    results = []
+    for comment in comments:
+      try:
+        self.wait_for_rate_limit()
+        results.append(self.publish_comment(comment))
+      except Exception, e:
+        results.append(e)
+    return results
+
+
+class PublishedIndex(db.Model):
+  """The posts that were already published to a migration's destination.
+
+  Fetched and stored by Destination.find_published(). The key name is the
+  migration's key name.
+  """
+  fetched = db.DateTimeProperty(required=True)
+  # dict mapping published_marker() to string destination id, encoded with
+  # storage.encode()
+  data = db.BlobProperty(required=True)
+
 
 class Migration(Base):
   """A migration from a single source to a single destination.
@@ -151,6 +383,29 @@ class Migration(Base):
   status = db.StringProperty(choices=STATUSES, default='new')
   id = db.IntegerProperty(required=True)
   stopped = db.BooleanProperty(required=True, default=False)
+  # if True, the source is periodically re-scanned for new posts
+  sync = db.BooleanProperty(default=False)
+  # source-specific mark for the newest post seen so far, e.g. a timestamp or
+  # tweet id. see Source.get_high_water_mark().
+  high_water_mark = db.IntegerProperty()
+  # optional window of posts to migrate, in UTC. since is inclusive, until is
+  # exclusive. sources translate these into their own API query parameters.
+  since = db.DateTimeProperty()
+  until = db.DateTimeProperty()
+  # the initial scan runs as this many parallel task chains, each over its own
+  # time slice. see shard_windows().
+  shards = db.IntegerProperty(default=1)
+  shards_done = db.ListProperty(int)
+  # kinds of posts and comments that may still be new, and when one was last
+  # added. used when PROPAGATE_MODE is 'fair'. see tasks.Dispatch.
+  pending_kinds = db.StringListProperty()
+  pending_updated = db.DateTimeProperty()
+  # add_pending_kinds() only updates pending_updated if it's at least this old.
+  # must be shorter than remove_pending_kind()'s min_age.
+  PENDING_REFRESH = datetime.timedelta(seconds=30)
+  # length of the time buckets that add_propagate_batch_task() names tasks
+  # after. about how long a PropagateBatch task takes to publish a full batch.
+  BATCH_TASK_SECS = 30
 
   # lazily cached entities
   cached_source = None
@@ -176,6 +431,257 @@ class Migration(Base):
       self.cached_dest = db.get(self.dest_key())
     return self.cached_dest
 
+  @staticmethod
+  def propagate_batch_task(key, kind, countdown=0, fair=False, name=None):
+    """Returns a taskqueue.Task that propagates new entities of a kind in batch.
+
+    Args:
+      key: db.Key of the Migration
+      kind: string Migratable kind
+      countdown: integer seconds
+      fair: boolean, whether the task was added by tasks.Dispatch
+      name: string task name, optional
+    """
+    # when the task becomes runnable, so the countdown isn't counted as queue
+    # wait
+    params = {'kind': kind, 'migration': key.name(),
+              'enqueued': time.time() + countdown}
+    if fair:
+      params['fair'] = 'true'
+    return taskqueue.Task(url='/_ah/queue/propagate_batch', params=params,
+                          countdown=countdown, name=name)
+
+  @staticmethod
+  def add_propagate_batch_task(key, kind, countdown=0):
+    """Adds a propagate_batch task, unless one is already waiting to run.
+
+    Used when PROPAGATE_MODE is 'batch'. get_or_save_all() calls this for every
+    page of posts and every post's comments, so the tasks are named after the
+    migration, the kind, and the BATCH_TASK_SECS time bucket that the
+    countdown ends in, and each runs at the end of its bucket. So at most one
+    task runs per bucket, instead of one chain of tasks per call, and it still
+    sees every entity that was saved before any add in its bucket.
+
+    Args:
+      key: db.Key of the Migration
+      kind: string Migratable kind
+      countdown: integer seconds, the minimum countdown
+
+    Returns: boolean, whether a task was added
+    """
+    bucket = int((time.time() + countdown) // Migration.BATCH_TASK_SECS) + 1
+    name = 'batch-%s-%s-%d' % (hashlib.sha1(key.name()).hexdigest(), kind,
+                               bucket)
+    task = Migration.propagate_batch_task(
+      key, kind, countdown=bucket * Migration.BATCH_TASK_SECS - time.time(),
+      name=name)
+    try:
+      task.add(queue_name='propagate')
+      return True
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      logging.debug('Task %s already added', name)
+      return False
+
+  @staticmethod
+  def add_pending_kinds(key, kinds):
+    """Records that a migration has new posts or comments of some kinds.
+
+    Skips the transactional write if the kinds are all pending already and
+    pending_updated is less than PENDING_REFRESH old, since this is called for
+    every page of posts and every post's comments, and scan shards write the
+    same entity group.
+
+    Args:
+      key: db.Key of the Migration
+      kinds: sequence of string Migratable kinds
+
+    Returns: boolean, whether the migration was written
+    """
+    migration = db.get(key)
+    if (set(kinds) <= set(migration.pending_kinds) and
+        migration.pending_updated and
+        datetime.datetime.now() - migration.pending_updated <
+          Migration.PENDING_REFRESH):
+      return False
+
+    @db.transactional
+    def update():
+      migration = db.get(key)
+      migration.pending_kinds = sorted(
+        set(migration.pending_kinds) | set(kinds))
+      migration.pending_updated = datetime.datetime.now()
+      migration.save()
+
+    update()
+    return True
+
+  @staticmethod
+  @db.transactional
+  def remove_pending_kind(key, kind, min_age):
+    """Records that a migration has no more new posts or comments of a kind.
+
+    Does nothing if any kind was marked pending less than min_age ago, since
+    queries for new entities are eventually consistent and may have missed
+    them. add_pending_kinds() may not have updated pending_updated for up to
+    PENDING_REFRESH, so min_age should be longer than that.
+
+    Args:
+      key: db.Key of the Migration
+      kind: string Migratable kind
+      min_age: datetime.timedelta
+
+    Returns: boolean, whether the kind was removed
+    """
+    migration = db.get(key)
+    if (kind not in migration.pending_kinds or
+        datetime.datetime.now() - migration.pending_updated < min_age):
+      return False
+    migration.pending_kinds.remove(kind)
+    migration.save()
+    return True
+
+  def queue_wait_samples_name(self):
+    """Returns the record_sample() name for this migration's queue waits."""
+    return 'queue_wait %s' % self.key().name()
+
+  def window_timestamps(self):
+    """Returns (since, until) as integer UTC Unix timestamps, or None if unset."""
+    return tuple(to_timestamp(dt) if dt else None
+                 for dt in (self.since, self.until))
+
+  def shard_windows(self, num_shards, epoch, now=None):
+    """Splits this migration's window into time slices for parallel scans.
+
+    The slices are evenly sized and run from the later of since and epoch to
+    the earlier of until and now. The first slice starts at since and the last
+    ends at until, so either may be None, ie unbounded.
+
+    Args:
+      num_shards: integer
+      epoch: datetime, the source's earliest possible post
+      now: datetime, defaults to the current time
+
+    Returns: list of (since, until) tuples of integer UTC Unix timestamps or
+      Nones, newest last
+    """
+    since, until = self.window_timestamps()
+    start = max(since or 0, to_timestamp(epoch))
+    end = until or to_timestamp(now or datetime.datetime.utcnow())
+    if num_shards <= 1 or end <= start:
+      return [(since, until)]
+
+    step = (end - start) // num_shards
+    bounds = [start + i * step for i in range(1, num_shards)]
+    return zip([since] + bounds, bounds + [until])
+
+  def finish_shard(self, shard):
+    """Records that a scan shard is done, transactionally.
+
+    Args:
+      shard: integer
+
+    Returns: boolean, whether all of this migration's scan shards are done
+    """
+    @db.transactional
+    def update():
+      migration = db.get(self.key())
+      if shard not in migration.shards_done:
+        migration.shards_done.append(shard)
+        migration.save()
+      return migration.shards_done
+
+    self.shards_done = update()
+    return self.scan_done()
+
+  def scan_done(self):
+    """Returns True if all of this migration's scan shards are done."""
+    return len(set(self.shards_done)) >= self.shards
+
+  def raise_high_water_mark(self, mark):
+    """Sets high_water_mark to mark if it's higher, transactionally.
+
+    Args:
+      mark: integer
+    """
+    if self.high_water_mark is not None and mark <= self.high_water_mark:
+      return
+
+    @db.transactional
+    def update():
+      migration = db.get(self.key())
+      if migration.high_water_mark is None or mark > migration.high_water_mark:
+        migration.high_water_mark = mark
+        migration.save()
+      return migration.high_water_mark
+
+    self.high_water_mark = update()
+
+
+# Caches shared by all Migratables in this instance. render_cache maps
+# (activity object hash, source name) to rendered HTML, so that e.g. the
+# comments of a post don't render identical content more than once.
+# source_names maps Migration key to source type display name. Both are cleared
+# when they reach CACHE_SIZE.
+CACHE_SIZE = 1000
+render_cache = {}
+source_names = {}
+
+# maps Migration key name to (fetched datetime, index) for each migration's
+# index of published posts. see Destination.find_published().
+published_indexes = {}
+# how long another task waits while one fetches a published index
+PUBLISHED_INDEX_LOCK_SECS = 60
+# below the datastore's 1MB entity limit
+MAX_PUBLISHED_INDEX_BYTES = 900 * 1024
+
+
+def cache_put(cache, key, value):
+  """Adds a value to one of the caches above, clearing it first if it's full."""
+  if len(cache) >= CACHE_SIZE:
+    cache.clear()
+  cache[key] = value
+
+
+def record_sample(name, value, max_samples=50):
+  """Adds a value to a named list of recent samples, stored in memcache.
+
+  Not atomic, so concurrent callers occasionally lose samples, which is fine.
+
+  Args:
+    name: string
+    value: any picklable value, usually a number
+    max_samples: integer, how many of the most recent samples to keep
+  """
+  key = 'samples %s' % name
+  samples = memcache.get(key) or []
+  samples.append(value)
+  memcache.set(key, samples[-max_samples:])
+
+
+def get_samples(name):
+  """Returns the list of recent samples added by record_sample(), oldest first.
+  """
+  return memcache.get('samples %s' % name) or []
+
+
+# Set to True to store posts and comments exactly as the source returns them,
+# without pruning them to Migratable.SCHEMA. Useful for debugging converters.
+STORE_RAW_DATA = False
+
+# How get_or_save_all() queues new posts and comments to be propagated:
+#   push: one propagate push task per post or comment
+#   batch: propagate_batch push tasks, at most one per migration, kind and
+#     Migration.BATCH_TASK_SECS
+#   pull: one task per post or comment in the propagate-pull pull queue, for
+#     tasks.PropagateWorker
+#   fair: no tasks. records each migration's pending kinds, and tasks.Dispatch
+#     adds propagate_batch tasks for all migrations round robin.
+PROPAGATE_MODE = 'push'
+
+# in push mode, posts published more recently than this go in the
+# propagate-recent priority lane. see Migratable.propagate_queue().
+RECENT_POST_AGE = datetime.timedelta(days=30)
+
 
 class Migratable(Base):
   """A post or comment to be migrated.
@@ -185,13 +691,37 @@ class Migratable(Base):
   """
 
   TYPE = None  # subclasses should set this to 'post' or 'comment'
-  STATUSES = ('new', 'processing', 'complete')
+  # storage.prune() schema for the source data. Should include all fields that
+  # to_activity() and render_html() use. Other fields are dropped before the
+  # data is stored. None means keep everything.
+  SCHEMA = None
+  # Subclasses that convert source data to ActivityStreams in convert() should
+  # set this to an integer and increment it whenever the conversion changes.
+  # Stored activities from other versions are reconverted lazily. None means
+  # activities aren't stored, e.g. because the data is already ActivityStreams.
+  ACTIVITY_VERSION = None
+  # failed means propagating hit a permanent error, or too many transient ones
+  STATUSES = ('new', 'processing', 'complete', 'failed')
 
   status = db.StringProperty(choices=STATUSES, default='new')
   last_updated = db.DateTimeProperty(auto_now=True)
   leased_until = db.DateTimeProperty()
-  # JSON data for this post from the source social network's API.
+  # when the current or most recent lease started
+  leased_at = db.DateTimeProperty()
+  # when a propagate task last started publishing this post. if it's set, that
+  # task may have published it. see tasks.Propagate.publish().
+  publish_started = db.DateTimeProperty()
+  # why propagating failed, if status is failed
+  failed_reason = db.TextProperty()
+  # JSON data for this post from the source social network's API. Only
+  # populated in older entities. Newer entities use encoded_data instead.
   json_data = db.TextProperty()
+  # the same data, encoded with storage.encode()
+  encoded_data = db.BlobProperty()
+  # the ActivityStreams activity converted from the data, encoded with
+  # storage.encode(), and the ACTIVITY_VERSION that converted it
+  activity_data = db.BlobProperty()
+  activity_version = db.IntegerProperty()
   # duplicated here (as well as in the key name) so it can be queried.
   migration = db.ReferenceProperty(Migration)
   # the destination-specific id of the migrated copy of this entity
@@ -201,8 +731,34 @@ class Migratable(Base):
 
   # dict, cached copy of decoded JSON data
   parsed_data = None
+  # memoized to_activity() and render_html() results
+  cached_activity = None
+  cached_html = None
 
-  def to_activity(self):
+  def __init__(self, *args, **kwargs):
+    """Accepts an optional data kwarg, the already decoded JSON data dict.
+
+    When data is provided, it isn't encoded until the entity is saved,
+    so that posts and comments that already exist are never serialized, and
+    data() never re-parses what the source just decoded. See encode_data().
+
+    The data is pruned to SCHEMA unless STORE_RAW_DATA is set.
+    """
+    data = kwargs.pop('data', None)
+    super(Migratable, self).__init__(*args, **kwargs)
+    if data is not None:
+      if self.SCHEMA is not None and not STORE_RAW_DATA:
+        data = storage.prune(data, self.SCHEMA)
+      self.parsed_data = data
+
+  def put(self, **kwargs):
+    """Serializes the JSON data if necessary, then saves."""
+    self.encode_data()
+    return super(Migratable, self).put(**kwargs)
+
+  save = put
+
+  def convert(self):
     """Converts this to an ActivityStreams activity.
 
     To be implemented by subclasses.
@@ -211,10 +767,65 @@ class Migratable(Base):
     """
     raise NotImplementedError()
 
+  def to_activity(self):
+    """Returns this as an ActivityStreams activity.
+
+    Uses the stored activity if the current ACTIVITY_VERSION converted it.
+    Otherwise, converts with convert() and stores the result in activity_data,
+    to be saved along with the entity.
+
+    Memoized for the lifetime of this instance, so destinations may modify the
+    returned activity, e.g. to point to an uploaded copy of an image, and
+    render_html() will use the modified version.
+
+    Returns: ActivityStreams activity dict
+    """
+    if self.cached_activity is not None:
+      return self.cached_activity
+
+    if self.ACTIVITY_VERSION is None:
+      activity = self.convert()
+    elif (self.activity_data is not None and
+          self.activity_version == self.ACTIVITY_VERSION):
+      activity = storage.decode(self.activity_data)
+    else:
+      activity = self.convert()
+      self.activity_data = db.Blob(storage.encode(activity))
+      self.activity_version = self.ACTIVITY_VERSION
+
+    self.cached_activity = activity
+    return activity
+
   def render_html(self):
-    """Returns an HTML string rendering of this object."""
-    return activitystreams.render_html(self.to_activity()['object'],
-                                       self.migration.source().type_display_name())
+    """Returns an HTML string rendering of this object.
+
+    Memoized for the lifetime of this instance, and cached in render_cache.
+    """
+    if self.cached_html is None:
+      obj = self.to_activity()['object']
+      source_name = self.source_name()
+      key = (hashlib.sha1(json.dumps(obj, sort_keys=True)).hexdigest(),
+             source_name)
+      html = render_cache.get(key)
+      if html is None:
+        html = activitystreams.render_html(obj, source_name)
+        cache_put(render_cache, key, html)
+      self.cached_html = html
+
+    return self.cached_html
+
+  def source_name(self):
+    """Returns the display name of this entity's source type, e.g. 'Facebook'.
+
+    Cached in source_names, so that e.g. a post's comments don't all fetch the
+    migration and source.
+    """
+    migration_key = Migratable.migration.get_value_for_datastore(self)
+    name = source_names.get(migration_key)
+    if name is None:
+      name = self.migration.source().type_display_name()
+      cache_put(source_names, migration_key, name)
+    return name
 
   def get_comments(self):
     """Fetches this post's comments.
@@ -234,33 +845,216 @@ class Migratable(Base):
       logging.info('Deferring to existing entity: %s', key_str)
     else:
       logging.info('Creating new entity: %s', key_str)
-      self.migration = db.Key.from_path('Migration',
-                                        ' '.join(self.key_name_parts()[1:]))
+      self.set_migration()
       self.save()
       entity = self
 
     if entity.status == 'new':
       logging.info('Adding propagate task')
-      taskqueue.add(queue_name='propagate',
-                    params={'kind': self.kind(), 'key_name': self.key().name()},
-                    countdown=task_countdown,
-                    transactional=True)
+      entity.propagate_task(countdown=task_countdown).add(
+        queue_name=entity.propagate_queue(), transactional=True)
     return entity
 
+  @staticmethod
+  def get_or_save_all(entities, task_countdown=0, add_tasks=True):
+    """Batch version of get_or_save().
+
+    Looks up all of the entities with a single multi-key get, saves the ones
+    that don't exist yet with a single batch put, and adds propagate tasks for
+    all of them that are still new with a single batch task add. The kind of
+    tasks depends on PROPAGATE_MODE.
+
+    This isn't transactional, but it's still idempotent. Entities are saved
+    before their tasks are added, and a retry adds tasks for every entity that
+    is still new, whether or not it was created by this call. Any resulting
+    duplicate propagate tasks are handled by Propagate's lease.
+
+    Args:
+      entities: sequence of Migratables
+      task_countdown: integer, countdown in seconds for the first propagate
+        task. Each subsequent task is delayed by one more second.
+      add_tasks: boolean, whether to add propagate tasks. If False, the caller
+        must add them, e.g. with add_propagate_tasks().
+
+    Returns: list of Migratables, the stored entity for each input entity:
+      the input entity itself if it was new, or the existing entity otherwise.
+    """
+    if not entities:
+      return []
+
+    stored = db.get([e.key() for e in entities])
+    results = []
+    new = []
+    for entity, existing in zip(entities, stored):
+      key_str = '%s %s' % (entity.kind(), entity.key().name())
+      if existing:
+        logging.info('Deferring to existing entity: %s', key_str)
+        results.append(existing)
+      else:
+        logging.info('Creating new entity: %s', key_str)
+        entity.set_migration()
+        entity.encode_data()
+        new.append(entity)
+        results.append(entity)
+
+    if new:
+      db.put(new)
+
+    if add_tasks:
+      Migratable.add_propagate_tasks(results, task_countdown=task_countdown)
+    return results
+
+  @staticmethod
+  def add_propagate_tasks(entities, task_countdown=0):
+    """Adds propagate tasks for the entities that are new, in batches.
+
+    The kind of tasks depends on PROPAGATE_MODE. In push mode, they're added
+    to each entity's priority lane, from propagate_queue().
+
+    Args:
+      entities: sequence of Migratables
+      task_countdown: integer, countdown in seconds for the first propagate
+        task. In push mode, each subsequent task is delayed by one more second.
+
+    Returns: integer, the number of tasks added
+    """
+    new = [e for e in entities if e.status == 'new']
+    # maps queue name to list of tasks
+    tasks = collections.defaultdict(list)
+
+    if PROPAGATE_MODE == 'fair':
+      pending = collections.defaultdict(set)
+      for e in entities:
+        if e.status == 'new':
+          pending[Migratable.migration.get_value_for_datastore(e)].add(e.kind())
+      for key, kinds in pending.items():
+        Migration.add_pending_kinds(key, kinds)
+      return 0
+    elif PROPAGATE_MODE == 'batch':
+      batches = set((e.kind(), Migratable.migration.get_value_for_datastore(e))
+                    for e in new)
+      return sum(Migration.add_propagate_batch_task(key, kind,
+                                                    countdown=task_countdown)
+                 for kind, key in batches)
+    elif PROPAGATE_MODE == 'pull':
+      tasks['propagate-pull'] = [e.propagate_pull_task(countdown=task_countdown)
+                                 for e in new]
+    else:
+      for i, e in enumerate(new):
+        tasks[e.propagate_queue()].append(
+          e.propagate_task(countdown=task_countdown + i))
+
+    num_tasks = 0
+    for queue_name, queue_tasks in tasks.items():
+      logging.info('Adding %d %s tasks', len(queue_tasks), queue_name)
+      queue = taskqueue.Queue(queue_name)
+      for i in range(0, len(queue_tasks), taskqueue.MAX_TASKS_PER_ADD):
+        queue.add(queue_tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+      num_tasks += len(queue_tasks)
+
+    return num_tasks
+
+  @staticmethod
+  def kinds():
+    """Returns the Migratable subclasses that have a TYPE, ie concrete ones."""
+    classes = []
+    subclasses = Migratable.__subclasses__()
+    while subclasses:
+      cls = subclasses.pop()
+      if cls.TYPE:
+        classes.append(cls)
+      subclasses.extend(cls.__subclasses__())
+    return classes
+
+  def set_migration(self):
+    """Populates the migration property from the key name."""
+    self.migration = db.Key.from_path('Migration', self.migration_key_name())
+
+  def migration_key_name(self):
+    """Returns the key name of this post or comment's migration."""
+    return ' '.join(self.key_name_parts()[1:])
+
+  def propagate_task(self, countdown=0):
+    """Returns a taskqueue.Task that propagates this entity.
+
+    The task can go in any of the priority lanes from propagate_queue().
+    """
+    return taskqueue.Task(url='/_ah/queue/propagate',
+                          params={'kind': self.kind(),
+                                  'key_name': self.key().name()},
+                          countdown=countdown)
+
+  def propagate_queue(self):
+    """Returns the name of the priority lane for this entity's propagate task.
+
+    Recent posts go first, then older posts, then comments. The lanes are push
+    queues, defined in queue.yaml, each with its own rate.
+    """
+    assert self.TYPE in ('post', 'comment'), \
+        'Unknown type %r for %s' % (self.TYPE, self.kind())
+    if self.TYPE == 'comment':
+      return 'propagate-comments'
+
+    published = self.to_activity().get('object', {}).get('published') or ''
+    try:
+      published = datetime.datetime.strptime(published[:10], '%Y-%m-%d')
+    except ValueError:
+      return 'propagate-posts'
+
+    recent = datetime.datetime.utcnow() - published < RECENT_POST_AGE
+    return 'propagate-recent' if recent else 'propagate-posts'
+
+  def propagate_pull_task(self, countdown=0):
+    """Returns a pull queue taskqueue.Task for propagating this entity.
+
+    The payload is the entity's string key.
+    """
+    return taskqueue.Task(payload=str(self.key()), method='PULL',
+                          countdown=countdown)
+
+  def marker(self):
+    """Returns a string that identifies this post or comment across sources.
+
+    Destinations store it with published posts, e.g. in a WordPress custom
+    field, so they can find them later. See Destination.find_published().
+    """
+    return '%s:%s' % (self.kind(), self.id())
+
   def id(self):
     """Returns the source id of this post or comment."""
     return self.key_name_parts()[0]
 
   def dest(self):
     """Returns the destination for this post or comment."""
-    return db.get(db.Key.from_path(*self.key_name_parts()[3:]))
+    return db.get(self.dest_key_for(self.key()))
+
+  @staticmethod
+  def dest_key_for(key):
+    """Returns the destination Key for a post or comment Key."""
+    return db.Key.from_path(*key.name().split(' ')[3:])
 
   def data(self):
     """Returns the JSON data as a dict. Parses lazily and caches the result."""
     if self.parsed_data is None:
-      self.parsed_data = json.loads(self.json_data)
+      if self.encoded_data is not None:
+        self.parsed_data = storage.decode(self.encoded_data)
+      else:
+        self.parsed_data = json.loads(self.json_data)
     return self.parsed_data
 
+  def encode_data(self):
+    """Populates encoded_data and activity_data, if they aren't already.
+
+    Also reconverts activity_data if it's from an old ACTIVITY_VERSION.
+    """
+    if (self.encoded_data is None and self.json_data is None and
+        self.parsed_data is not None):
+      self.encoded_data = db.Blob(storage.encode(self.parsed_data))
+
+    if (self.ACTIVITY_VERSION is not None and
+        self.activity_version != self.ACTIVITY_VERSION):
+      self.to_activity()
+
 
 class OAuthToken(db.Model):
   """An OAuth 1.0A token. Key name is the token key.
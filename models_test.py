@@ -3,13 +3,19 @@
 
 __author__ = ['Ryan Barrett <freedom@ryanb.org>']
 
+import datetime
 import json
 import mox
 
+from activitystreams import activitystreams
 import appengine_config
-from models import Migratable
+import models
+import storage
+from models import Migratable, Migration
 from webutil import testutil
 
+from google.appengine.ext import db
+
 
 POST_VARS = {
   'id': 'tag:facebook.com,2012:10102828452385634_39170557',
@@ -23,6 +29,20 @@ POST_VARS = {
   }
 
 
+class FakeMigratable(Migratable):
+  """Converts by wrapping its data in an activity. Counts conversions."""
+  ACTIVITY_VERSION = 2
+  conversions = 0
+
+  def convert(self):
+    FakeMigratable.conversions += 1
+    return {'object': self.data()}
+
+
+class FakeMigratableComment(Migratable):
+  TYPE = 'comment'
+
+
 class SourceTest(testutil.HandlerTest):
 
   def _test_create_new(self):
@@ -48,6 +68,47 @@ class SourceTest(testutil.HandlerTest):
     self._test_create_new()
 
 
+class MigrationTest(testutil.HandlerTest):
+
+  def test_raise_high_water_mark(self):
+    migration = Migration(key_name='Facebook 1 WordPress http://my/xmlrpc', id=1)
+    migration.save()
+
+    for mark, expected in (5, 5), (3, 5), (8, 8):
+      migration.raise_high_water_mark(mark)
+      self.assertEqual(expected, migration.high_water_mark)
+      self.assertEqual(expected, Migration.get(migration.key()).high_water_mark)
+
+
+  def test_shard_windows(self):
+    migration = Migration(key_name='Facebook 1 WordPress http://my/xmlrpc', id=1)
+    epoch = datetime.datetime(2004, 1, 1)
+    now = datetime.datetime(2014, 1, 1)
+    start = models.to_timestamp(epoch)
+    step = (models.to_timestamp(now) - start) // 4
+
+    self.assertEqual([(None, start + step),
+                      (start + step, start + step * 2),
+                      (start + step * 2, start + step * 3),
+                      (start + step * 3, None)],
+                     migration.shard_windows(4, epoch, now=now))
+    self.assertEqual([(None, None)], migration.shard_windows(1, epoch, now=now))
+
+    # a window after now can't be split
+    migration.since = datetime.datetime(2015, 1, 1)
+    since = models.to_timestamp(migration.since)
+    self.assertEqual([(since, None)], migration.shard_windows(4, epoch, now=now))
+
+  def test_finish_shard(self):
+    migration = Migration(key_name='Facebook 1 WordPress http://my/xmlrpc', id=1,
+                          shards=2)
+    migration.save()
+    self.assertFalse(migration.finish_shard(1))
+    self.assertFalse(migration.finish_shard(1))
+    self.assertTrue(migration.finish_shard(0))
+    self.assertTrue(Migration.get(migration.key()).scan_done())
+
+
 class MigratableTest(testutil.HandlerTest):
 
   def setUp(self):
@@ -74,6 +135,90 @@ class MigratableTest(testutil.HandlerTest):
     same = saved.get_or_save()
     self.assertEqual(1, len(tasks))
 
+  def test_get_or_save_all(self):
+    migration = 'Facebook 1 WordPress http://my/xmlrpc'
+    comments = [FakeMigratableComment(key_name_parts=(id, migration))
+                for id in ('1', '2', '3')]
+    comments[1].status = 'complete'
+    comments[1].save()
+
+    saved = Migratable.get_or_save_all(comments)
+    self.assertEqual([c.key() for c in comments], [s.key() for s in saved])
+    self.assertEqual(['new', 'complete', 'new'], [s.status for s in saved])
+    self.assertEqual(3, FakeMigratableComment.all().count())
+    self.assertEqual(migration, saved[0].migration.key().name())
+
+    # only new entities get propagate tasks, in the comments lane
+    tasks = self.taskqueue_stub.GetTasks('propagate-comments')
+    self.assertEqual(['1 ' + migration, '3 ' + migration],
+                     [testutil.get_task_params(t)['key_name'] for t in tasks])
+
+    # retrying re-adds tasks for entities that are still new
+    Migratable.get_or_save_all(comments)
+    self.assertEqual(3, FakeMigratableComment.all().count())
+    self.assertEqual(
+      4, len(self.taskqueue_stub.GetTasks('propagate-comments')))
+
+  def test_data_kwarg(self):
+    post = Migratable(key_name_parts=('1', 'Facebook 1 WordPress http://my/xmlrpc'),
+                      data=POST_VARS)
+    self.assertIs(POST_VARS, post.data())
+    self.assertIsNone(post.encoded_data)
+
+    post.save()
+    self.assertIsNone(post.json_data)
+    self.assertEqual(POST_VARS, storage.decode(post.encoded_data))
+    self.assertEqual(POST_VARS, Migratable.get(post.key()).data())
+
+  def test_activity_stored_at_save(self):
+    FakeMigratable.conversions = 0
+    post = FakeMigratable(key_name_parts=('1', 'Facebook 1 WordPress http://my/xmlrpc'),
+                          data=POST_VARS)
+    post.save()
+    self.assertEqual(1, FakeMigratable.conversions)
+    self.assertEqual(2, post.activity_version)
+
+    # stored activity is current, so no conversion
+    loaded = FakeMigratable.get(post.key())
+    self.assertEqual({'object': POST_VARS}, loaded.to_activity())
+    self.assertEqual(1, FakeMigratable.conversions)
+
+    # stored activity is from an old version, so reconvert and store
+    loaded = FakeMigratable.get(post.key())
+    loaded.activity_version = 1
+    loaded.save()
+    self.assertEqual(2, FakeMigratable.conversions)
+    loaded = FakeMigratable.get(post.key())
+    self.assertEqual(2, loaded.activity_version)
+    self.assertEqual({'object': POST_VARS}, loaded.to_activity())
+    self.assertEqual(2, FakeMigratable.conversions)
+
+  def test_render_html_memoized_and_cached(self):
+    self.mox.StubOutWithMock(activitystreams, 'render_html')
+    activitystreams.render_html({'content': 'foo'}, 'Fake').AndReturn('<p>foo</p>')
+    self.mox.ReplayAll()
+
+    migration = 'Fake 1 WordPress http://my/xmlrpc'
+    models.source_names[db.Key.from_path('Migration', migration)] = 'Fake'
+    posts = [FakeMigratable(key_name_parts=(id, migration),
+                            data={'content': 'foo'})
+             for id in ('1', '2')]
+    for post in posts:
+      post.set_migration()
+      self.assertEqual('<p>foo</p>', post.render_html())
+      self.assertEqual('<p>foo</p>', post.render_html())
+
+    # to_activity() is memoized, so modifications show up
+    self.assertIs(posts[0].to_activity(), posts[0].to_activity())
+
+  def test_legacy_json_data(self):
+    post = Migratable(key_name_parts=('1', 'Facebook 1 WordPress http://my/xmlrpc'),
+                      json_data=json.dumps(POST_VARS))
+    post.save()
+    loaded = Migratable.get(post.key())
+    self.assertEqual(POST_VARS, loaded.data())
+    self.assertIsNone(loaded.encoded_data)
+
   def test_envelope(self):
     self.expect_urlfetch('https://facebook-webfinger.appspot.com/user_key'
                          '?uri=acct:ryan@facebook.com&secret=my_secret',
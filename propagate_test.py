@@ -0,0 +1,762 @@
+#!/usr/bin/python
+"""Unit tests for the propagate handlers in tasks.py.
+"""
+
+__author__ = ['Ryan Barrett <freedom@ryanb.org>']
+
+import collections
+import datetime
+import mox
+import time
+import urlparse
+from webob import exc
+import xmlrpclib
+
+import errors
+import models
+import ratelimit
+import tasks
+from tasks import Dispatch, Propagate
+from webutil import testutil
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.api import urlfetch
+from google.appengine.ext import db
+
+
+class FakeDestination(models.Destination):
+  published = []
+
+  def publish_post(self, post):
+    return 'dest %s' % post.id()
+
+  def publish_comment(self, comment):
+    if comment.id() == 'bad':
+      raise Exception('foo')
+    FakeDestination.published.append(comment.id())
+    return 'dest %s' % comment.id()
+
+
+class FakeComment(models.Migratable):
+  TYPE = 'comment'
+
+  def convert(self):
+    return {'object': self.data()}
+
+
+class FakePost(models.Migratable):
+  TYPE = 'post'
+
+  def convert(self):
+    return {'object': self.data()}
+
+  def get_comments(self):
+    parts = self.key_name_parts()[1:]
+    return [FakeComment(key_name_parts=[id] + parts,
+                        data={'id': id, 'published': published})
+            for id, published in (('3', '2013-03-03'), ('bad', '2013-02-02'),
+                                  ('1', '2013-01-01'))]
+
+
+class PropagateDatastoreOpsTest(testutil.HandlerTest):
+  """Checks how many datastore round trips propagating a comment takes."""
+
+  def setUp(self):
+    super(PropagateDatastoreOpsTest, self).setUp()
+    FakeDestination(key_name='http://my/blog').save()
+    self.comment = FakeComment(
+      key_name_parts=('1', 'Facebook', '2', 'FakeDestination', 'http://my/blog'),
+      data={'id': '1'})
+    self.comment.save()
+
+    self.calls = []
+    hooks = apiproxy_stub_map.apiproxy.GetPostCallHooks()
+    hooks.Append('count_ops', self.count_op, 'datastore_v3')
+    self.addCleanup(hooks.Clear)
+
+  def count_op(self, service, call, request, response):
+    if call in ('Get', 'Put'):
+      self.calls.append(call)
+
+  def test_comment_ops_budget(self):
+    resp = tasks.application.get_response(
+      '/_ah/queue/propagate', method='POST',
+      POST={'kind': 'FakeComment', 'key_name': self.comment.key().name()})
+    self.assertEqual(200, resp.status_int, resp.body)
+
+    comment = db.get(self.comment.key())
+    self.assertEqual('complete', comment.status)
+    self.assertEqual('dest 1', comment.dest_id)
+    # lease: one batch get of the comment and destination, one put.
+    # complete: one get, one put.
+    self.assertEqual(['Get', 'Put', 'Get', 'Put'], self.calls)
+
+
+class PropagateBatchTest(testutil.HandlerTest):
+
+  def setUp(self):
+    super(PropagateBatchTest, self).setUp()
+    FakeDestination(key_name='http://my/blog').save()
+    self.migration = models.Migration(
+      key_name_parts=('Facebook', '2', 'FakeDestination', 'http://my/blog'),
+      id=2)
+    self.migration.save()
+    self.comments = [FakeComment(key_name_parts=(id,) + tuple(
+                       self.migration.key_name_parts()), data={'id': id})
+                     for id in ('1', 'bad', '3')]
+
+  def post_batch(self, expected_status, retry_count=0):
+    resp = tasks.application.get_response(
+      '/_ah/queue/propagate_batch', method='POST',
+      POST={'kind': 'FakeComment', 'migration': self.migration.key().name()},
+      headers={'X-AppEngine-TaskRetryCount': str(retry_count)})
+    self.assertEqual(expected_status, resp.status_int, resp.body)
+
+  def save_comments(self):
+    for comment in self.comments:
+      comment.set_migration()
+    db.put(self.comments)
+
+  def statuses(self):
+    return [c.status for c in db.get([c.key() for c in self.comments])]
+
+  def test_get_or_save_all_adds_batch_task(self):
+    self.mox.stubs.Set(models, 'PROPAGATE_MODE', 'batch')
+    models.Migratable.get_or_save_all(self.comments)
+    tasks = self.taskqueue_stub.GetTasks('propagate')
+    self.assertEqual(1, len(tasks))
+    self.assertEqual('/_ah/queue/propagate_batch', tasks[0]['url'])
+
+  def test_get_or_save_all_merges_batch_tasks(self):
+    self.mox.stubs.Set(models, 'PROPAGATE_MODE', 'batch')
+    # the start of a time bucket, so both calls are in it
+    now = (time.time() // models.Migration.BATCH_TASK_SECS *
+           models.Migration.BATCH_TASK_SECS)
+    self.mox.stubs.Set(time, 'time', lambda: now)
+
+    models.Migratable.get_or_save_all(self.comments[:1])
+    models.Migratable.get_or_save_all(self.comments[1:])
+    self.assertEqual(1, len(self.taskqueue_stub.GetTasks('propagate')))
+
+    # a countdown into the next bucket adds another task
+    self.assertTrue(models.Migration.add_propagate_batch_task(
+      self.migration.key(), 'FakeComment',
+      countdown=models.Migration.BATCH_TASK_SECS))
+    self.assertEqual(2, len(self.taskqueue_stub.GetTasks('propagate')))
+
+  def test_lease_contention_skips(self):
+    self.save_comments()
+    lease = Propagate.lease
+
+    def contended_lease(key, **kwargs):
+      if key == self.comments[2].key():
+        raise db.TransactionFailedError()
+      return lease(key, **kwargs)
+
+    self.mox.stubs.Set(Propagate, 'lease', staticmethod(contended_lease))
+    self.post_batch(500)
+    self.assertEqual(['complete', 'new', 'new'], self.statuses())
+
+  def test_completes_published_when_batch_dies(self):
+    self.save_comments()
+
+    def release(key):
+      raise db.Timeout()
+
+    self.mox.stubs.Set(Propagate, 'release', staticmethod(release))
+    # so webapp2 returns a 500 instead of re-raising
+    self.mox.stubs.Set(tasks.application, 'debug', False)
+    self.post_batch(500)
+    # the batch died releasing 'bad'. the comments published before it are
+    # complete, and the rest weren't leased.
+    for comment, status in zip(self.comments, self.statuses()):
+      if comment.id() == 'bad':
+        self.assertEqual('processing', status)
+      else:
+        self.assertIn(status, ('complete', 'new'))
+
+  def test_partial_failure(self):
+    for comment in self.comments:
+      comment.set_migration()
+    db.put(self.comments)
+
+    self.post_batch(500)
+    statuses = [(c.status, c.dest_id)
+                for c in db.get([c.key() for c in self.comments])]
+    self.assertEqual([('complete', 'dest 1'), ('new', None),
+                      ('complete', 'dest 3')], statuses)
+
+  def test_last_attempt_fails_transient(self):
+    for comment in self.comments:
+      comment.set_migration()
+    db.put(self.comments)
+
+    self.post_batch(200, retry_count=Propagate.MAX_ATTEMPTS - 1)
+    bad = db.get(self.comments[1].key())
+    self.assertEqual('failed', bad.status)
+    self.assertIn('Gave up after 10 attempts', bad.failed_reason)
+
+  def test_rate_limited(self):
+    for comment in self.comments:
+      comment.set_migration()
+    db.put(self.comments)
+    self.mox.StubOutWithMock(ratelimit.TokenBucket, 'wait')
+    ratelimit.TokenBucket.wait(mox.IgnoreArg()).AndReturn(5)
+    self.mox.ReplayAll()
+
+    self.post_batch(200)
+    statuses = [c.status for c in db.get([c.key() for c in self.comments])]
+    self.assertEqual(['new'] * 3, statuses)
+    # a new task, with no retries
+    self.assertEqual(1, len(self.taskqueue_stub.GetTasks('propagate')))
+
+  def test_full_batch_adds_next_task(self):
+    self.mox.stubs.Set(tasks.PropagateBatch, 'BATCH_SIZE', 1)
+    self.comments[0].set_migration()
+    self.comments[0].save()
+
+    self.post_batch(200)
+    self.assertEqual('complete', db.get(self.comments[0].key()).status)
+    self.assertEqual(1, len(self.taskqueue_stub.GetTasks('propagate')))
+
+
+class RunInThreadsTest(testutil.HandlerTest):
+
+  def test_run_in_threads(self):
+    def fn(x):
+      if x == 3:
+        raise ValueError()
+      return x * 2
+
+    results = tasks.run_in_threads(fn, range(5), 2)
+    self.assertEqual([0, 2, 4], results[:3])
+    self.assertIsInstance(results[3], ValueError)
+    self.assertEqual(8, results[4])
+    self.assertEqual([], tasks.run_in_threads(fn, [], 2))
+
+
+FakeTask = collections.namedtuple('FakeTask', ('payload', 'retry_count'))
+
+
+class PropagateWorkerTest(testutil.HandlerTest):
+
+  def test_worker(self):
+    FakeDestination(key_name='http://my/blog').save()
+    comments = [FakeComment(key_name_parts=(id, 'Facebook', '2',
+                                            'FakeDestination', 'http://my/blog'),
+                            data={'id': id})
+                for id in ('1', 'bad')]
+    db.put(comments)
+    leased = [taskqueue.Task(payload=str(c.key()), method='PULL')
+              for c in comments]
+
+    self.mox.StubOutWithMock(taskqueue.Queue, 'lease_tasks')
+    self.mox.StubOutWithMock(taskqueue.Queue, 'delete_tasks')
+    taskqueue.Queue.lease_tasks(mox.IgnoreArg(), mox.IgnoreArg())\
+        .AndReturn(leased)
+    taskqueue.Queue.delete_tasks([leased[0]])
+    taskqueue.Queue.lease_tasks(mox.IgnoreArg(), mox.IgnoreArg()).AndReturn([])
+    self.mox.ReplayAll()
+
+    resp = tasks.application.get_response('/cron/propagate_worker')
+    self.assertEqual(200, resp.status_int, resp.body)
+    self.assertEqual(['complete', 'new'],
+                     [c.status for c in db.get([c.key() for c in comments])])
+
+  def test_gives_up(self):
+    FakeDestination(key_name='http://my/blog').save()
+    comment = FakeComment(key_name_parts=('bad', 'Facebook', '2',
+                                          'FakeDestination', 'http://my/blog'),
+                          data={'id': 'bad'})
+    comment.save()
+    leased = [FakeTask(str(comment.key()), Propagate.MAX_ATTEMPTS)]
+
+    self.mox.StubOutWithMock(taskqueue.Queue, 'lease_tasks')
+    self.mox.StubOutWithMock(taskqueue.Queue, 'delete_tasks')
+    taskqueue.Queue.lease_tasks(mox.IgnoreArg(), mox.IgnoreArg())\
+        .AndReturn(leased)
+    taskqueue.Queue.delete_tasks(leased)
+    taskqueue.Queue.lease_tasks(mox.IgnoreArg(), mox.IgnoreArg()).AndReturn([])
+    self.mox.ReplayAll()
+
+    resp = tasks.application.get_response('/cron/propagate_worker')
+    self.assertEqual(200, resp.status_int, resp.body)
+    self.assertEqual('failed', db.get(comment.key()).status)
+
+
+class PublishCommentsTest(testutil.HandlerTest):
+
+  def setUp(self):
+    super(PublishCommentsTest, self).setUp()
+    FakeDestination.published = []
+    self.mox.stubs.Set(tasks, 'COMMENT_THREADS', 2)
+    FakeDestination(key_name='http://my/blog').save()
+    self.post = FakePost(
+      key_name_parts=('9', 'Facebook', '2', 'FakeDestination', 'http://my/blog'),
+      data={'id': '9'})
+    self.post.save()
+
+  def propagate_post(self):
+    Propagate.propagate(self.post.key())
+    comments = db.GqlQuery('SELECT * FROM FakeComment').fetch(10)
+    self.assertEqual({'1': 'complete', '3': 'complete', 'bad': 'new'},
+                     {c.id(): c.status for c in comments})
+    # the failed comment's task is still there to retry it
+    self.assertEqual(
+      3, len(self.taskqueue_stub.GetTasks('propagate-comments')))
+
+  def test_publish_comments(self):
+    self.propagate_post()
+    self.assertEqual('complete', db.get(self.post.key()).status)
+    self.assertItemsEqual(['1', '3'], FakeDestination.published)
+
+  def test_ordered_comments(self):
+    self.mox.stubs.Set(FakeDestination, 'ORDERED_COMMENTS', True)
+    self.propagate_post()
+    self.assertEqual(['1', '3'], FakeDestination.published)
+
+  def test_batch_comments_only_adds_tasks_for_failures(self):
+    self.mox.stubs.Set(FakeDestination, 'BATCH_COMMENTS', True)
+    Propagate.propagate(self.post.key())
+    comments = db.GqlQuery('SELECT * FROM FakeComment').fetch(10)
+    self.assertEqual({'1': 'complete', '3': 'complete', 'bad': 'new'},
+                     {c.id(): c.status for c in comments})
+
+    retries = self.taskqueue_stub.GetTasks('propagate-comments')
+    self.assertEqual(1, len(retries))
+    self.assertTrue(testutil.get_task_params(retries[0])['key_name']
+                    .startswith('bad '))
+
+
+class LeaseLengthTest(testutil.HandlerTest):
+
+  def setUp(self):
+    super(LeaseLengthTest, self).setUp()
+    self.dest_key = db.Key.from_path('FakeDestination', 'http://my/blog')
+
+  def test_lease_length(self):
+    self.assertEqual(Propagate.LEASE_LENGTH,
+                     Propagate.lease_length(self.dest_key))
+
+    for secs in range(1, 21):
+      Propagate.record_latency(self.dest_key, secs)
+    # 95th percentile is 19s
+    self.assertEqual(datetime.timedelta(seconds=19 * 4),
+                     Propagate.lease_length(self.dest_key))
+
+    for i in range(Propagate.LATENCY_SAMPLES):
+      Propagate.record_latency(self.dest_key, .1)
+    self.assertEqual(Propagate.MIN_LEASE_LENGTH,
+                     Propagate.lease_length(self.dest_key))
+
+  def test_heartbeat_renews_lease(self):
+    FakeDestination(key_name='http://my/blog').save()
+    comment = FakeComment(
+      key_name_parts=('1', 'Facebook', '2', 'FakeDestination', 'http://my/blog'),
+      data={'id': '1'})
+    comment.save()
+
+    lease_length = datetime.timedelta(seconds=.03)
+    entity, dest = Propagate.lease(comment.key(), self.dest_key,
+                                   lease_length=lease_length)
+
+    renewed = []
+    orig_renew = Propagate.renew
+    def renew(key, leased_at, length):
+      renewed.append(key)
+      orig_renew(key, leased_at, length)
+    self.mox.stubs.Set(Propagate, 'renew', staticmethod(renew))
+
+    def slow_publish(entity, dest):
+      time.sleep(.1)
+      return 'x'
+    self.mox.stubs.Set(Propagate, 'publish', staticmethod(slow_publish))
+
+    self.assertEqual('x', Propagate.publish_with_heartbeat(entity, dest,
+                                                           lease_length))
+    self.assertTrue(renewed)
+    self.assertEqual(comment.key(), renewed[0])
+    self.assertEqual('processing', db.get(comment.key()).status)
+
+
+  def test_latency_is_only_publish_call(self):
+    FakeDestination(key_name='http://my/blog').save()
+    post = FakePost(
+      key_name_parts=('9', 'Facebook', '2', 'FakeDestination', 'http://my/blog'),
+      data={'id': '9'})
+    post.save()
+
+    def slow_fetch_published(dest):
+      time.sleep(.1)
+      return {}
+    self.mox.stubs.Set(FakeDestination, 'fetch_published', slow_fetch_published)
+
+    Propagate.propagate(post.key())
+    latencies = models.get_samples(
+      Propagate.latencies_samples_name(self.dest_key))
+    self.assertEqual(1, len(latencies))
+    self.assertLess(latencies[0], .1)
+
+
+class LeaseOwnershipTest(testutil.HandlerTest):
+
+  def test_complete_and_renew_check_lease(self):
+    comment = FakeComment(key_name_parts=(
+        '1', 'Facebook', '2', 'FakeDestination', 'http://my/blog'),
+      data={'id': '1'})
+    comment.save()
+    old = Propagate.lease(comment.key())[0]
+
+    # the lease expires and another task re-leases it
+    Propagate.release(comment.key())
+    new = Propagate.lease(comment.key())[0]
+    length = datetime.timedelta(minutes=1)
+
+    self.assertRaises(exc.HTTPConflict, Propagate.renew, comment.key(),
+                      old.leased_at, length)
+    self.assertEqual(new.leased_until, db.get(comment.key()).leased_until)
+    self.assertRaises(exc.HTTPConflict, Propagate.complete, comment.key(),
+                      old.leased_at, 'dest 1')
+    self.assertEqual('processing', db.get(comment.key()).status)
+
+    Propagate.renew(comment.key(), new.leased_at, length)
+    Propagate.complete(comment.key(), new.leased_at, 'dest 1')
+    self.assertEqual('complete', db.get(comment.key()).status)
+
+
+class CompleteAllTest(testutil.HandlerTest):
+
+  def test_skips_released(self):
+    parts = ('Facebook', '2', 'FakeDestination', 'http://my/blog')
+    comments = [FakeComment(key_name_parts=(id,) + parts, data={'id': id})
+                for id in ('1', '2')]
+    db.put(comments)
+    leased = [Propagate.lease(c.key())[0] for c in comments]
+
+    # the second lease expires and another task re-leases it
+    Propagate.release(comments[1].key())
+    released = Propagate.lease(comments[1].key())[0]
+    self.assertNotEqual(leased[1].leased_at, released.leased_at)
+
+    Propagate.complete_all([(leased[0], 'dest 1'), (leased[1], 'dest 2')])
+    self.assertEqual(
+      [('complete', 'dest 1'), ('processing', None)],
+      [(c.status, c.dest_id) for c in db.get([c.key() for c in comments])])
+
+  def test_retries(self):
+    parts = ('Facebook', '2', 'FakeDestination', 'http://my/blog')
+    comment = FakeComment(key_name_parts=('1',) + parts, data={'id': '1'})
+    comment.save()
+    leased = Propagate.lease(comment.key())[0]
+
+    put = db.put
+    calls = []
+
+    def flaky_put(entities):
+      calls.append(entities)
+      if len(calls) == 1:
+        raise db.Timeout()
+      return put(entities)
+
+    self.mox.stubs.Set(db, 'put', flaky_put)
+    Propagate.complete_all([(leased, 'dest 1')])
+    self.assertEqual(2, len(calls))
+    self.assertEqual('complete', db.get(comment.key()).status)
+
+
+class SweepTest(testutil.HandlerTest):
+
+  def test_sweep(self):
+    now = datetime.datetime.now()
+    parts = ('Facebook', '2', 'FakeDestination', 'http://my/blog')
+    expired, leased = [
+      FakeComment(key_name_parts=(id,) + parts, data={'id': id},
+                  status='processing', leased_until=leased_until)
+      for id, leased_until in (('1', now - datetime.timedelta(minutes=1)),
+                               ('2', now + datetime.timedelta(minutes=1)))]
+    db.put([expired, leased])
+
+    resp = tasks.application.get_response('/cron/sweep')
+    self.assertEqual(200, resp.status_int, resp.body)
+
+    self.assertEqual('new', db.get(expired.key()).status)
+    self.assertEqual('processing', db.get(leased.key()).status)
+    propagates = self.taskqueue_stub.GetTasks('propagate-comments')
+    self.assertEqual(1, len(propagates))
+    self.assertEqual(expired.key().name(),
+                     testutil.get_task_params(propagates[0])['key_name'])
+
+
+class DispatchTest(testutil.HandlerTest):
+
+  def setUp(self):
+    super(DispatchTest, self).setUp()
+    self.mox.stubs.Set(models, 'PROPAGATE_MODE', 'fair')
+    FakeDestination(key_name='http://my/blog').save()
+    self.migrations = []
+    for id in ('1', '2'):
+      migration = models.Migration(
+        key_name_parts=('Facebook', id, 'FakeDestination', 'http://my/blog'),
+        id=int(id))
+      migration.save()
+      self.migrations.append(migration)
+
+  def test_round_robin(self):
+    big = [FakeComment(key_name_parts=(str(i),) + tuple(
+             self.migrations[0].key_name_parts()), data={'id': str(i)})
+           for i in range(50)]
+    small = [FakeComment(key_name_parts=('x',) + tuple(
+               self.migrations[1].key_name_parts()), data={'id': 'x'})]
+    models.Migratable.get_or_save_all(big + small)
+    self.assertEqual([], self.taskqueue_stub.GetTasks('propagate'))
+    for m in self.migrations:
+      self.assertEqual(['FakeComment'], db.get(m.key()).pending_kinds)
+
+    resp = tasks.application.get_response('/cron/dispatch')
+    self.assertEqual(200, resp.status_int, resp.body)
+    params = [testutil.get_task_params(t)
+              for t in self.taskqueue_stub.GetTasks('propagate')]
+    self.assertEqual(2 * Dispatch.ROUNDS, len(params))
+    self.assertEqual(
+      set(m.key().name() for m in self.migrations),
+      set(p['migration'] for p in params[:2]))
+
+  def test_remove_pending_kind(self):
+    key = self.migrations[0].key()
+    models.Migration.add_pending_kinds(key, ['FakeComment'])
+    self.assertFalse(models.Migration.remove_pending_kind(
+      key, 'FakeComment', datetime.timedelta(minutes=1)))
+    self.assertTrue(models.Migration.remove_pending_kind(
+      key, 'FakeComment', datetime.timedelta(0)))
+    self.assertEqual([], db.get(key).pending_kinds)
+
+  def test_add_pending_kinds_skips_recent(self):
+    key = self.migrations[0].key()
+    self.assertTrue(models.Migration.add_pending_kinds(key, ['FakeComment']))
+    updated = db.get(key).pending_updated
+    self.assertFalse(models.Migration.add_pending_kinds(key, ['FakeComment']))
+    self.assertEqual(updated, db.get(key).pending_updated)
+
+    self.assertTrue(models.Migration.add_pending_kinds(key, ['FakePost']))
+    self.assertEqual(['FakeComment', 'FakePost'], db.get(key).pending_kinds)
+
+  def test_enqueued_after_countdown(self):
+    task = models.Migration.propagate_batch_task(
+      self.migrations[0].key(), 'FakeComment', countdown=40)
+    enqueued = float(urlparse.parse_qs(task.payload)['enqueued'][0])
+    self.assertAlmostEqual(time.time() + 40, enqueued, delta=5)
+
+
+class PropagateQueueTest(testutil.HandlerTest):
+
+  def test_propagate_queue(self):
+    parts = ('Facebook', '2', 'FakeDestination', 'http://my/blog')
+    recent = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S+0000')
+    for expected, cls, published in (
+        ('propagate-recent', FakePost, recent),
+        ('propagate-posts', FakePost, '2012-05-21T02:25:25+0000'),
+        ('propagate-posts', FakePost, None),
+        ('propagate-comments', FakeComment, recent)):
+      entity = cls(key_name_parts=('1',) + parts,
+                   data={'id': '1', 'published': published})
+      self.assertEqual(expected, entity.propagate_queue())
+
+  def test_unknown_type(self):
+    entity = models.Migratable(key_name_parts=(
+        '1', 'Facebook', '2', 'FakeDestination', 'http://my/blog'))
+    self.assertRaises(AssertionError, entity.propagate_queue)
+
+
+class PropagateFailureTest(testutil.HandlerTest):
+
+  def setUp(self):
+    super(PropagateFailureTest, self).setUp()
+    FakeDestination(key_name='http://my/blog').save()
+    self.comment = FakeComment(
+      key_name_parts=('1', 'Facebook', '2', 'FakeDestination', 'http://my/blog'),
+      data={'id': '1'})
+    self.comment.save()
+    self.mox.StubOutWithMock(FakeDestination, 'publish_comment')
+
+  def post_task(self, attempt=0):
+    resp = tasks.application.get_response(
+      '/_ah/queue/propagate', method='POST',
+      POST={'kind': 'FakeComment', 'key_name': self.comment.key().name(),
+            'attempt': attempt},
+      headers={'X-AppEngine-QueueName': 'propagate-comments'})
+    self.assertEqual(200, resp.status_int, resp.body)
+    return db.get(self.comment.key())
+
+  def test_permanent(self):
+    FakeDestination.publish_comment(mox.IgnoreArg()).AndRaise(
+      xmlrpclib.Fault(403, 'Incorrect username or password.'))
+    self.mox.ReplayAll()
+
+    comment = self.post_task()
+    self.assertEqual('failed', comment.status)
+    self.assertIn('Incorrect username', comment.failed_reason)
+    self.assertEqual([], self.taskqueue_stub.GetTasks('propagate-comments'))
+
+  def test_transient_retries_with_backoff(self):
+    FakeDestination.publish_comment(mox.IgnoreArg()).AndRaise(
+      urlfetch.DownloadError())
+    self.mox.ReplayAll()
+
+    self.assertEqual('new', self.post_task().status)
+    retries = self.taskqueue_stub.GetTasks('propagate-comments')
+    self.assertEqual(1, len(retries))
+    self.assertEqual('1', testutil.get_task_params(retries[0])['attempt'])
+
+  def test_rate_limited_doesnt_count(self):
+    self.mox.StubOutWithMock(ratelimit.TokenBucket, 'wait')
+    ratelimit.TokenBucket.wait(mox.IgnoreArg()).AndReturn(5)
+    self.mox.ReplayAll()
+
+    self.assertEqual('new', self.post_task(attempt=3).status)
+    retries = self.taskqueue_stub.GetTasks('propagate-comments')
+    self.assertEqual(1, len(retries))
+    self.assertEqual('3', testutil.get_task_params(retries[0])['attempt'])
+
+  def test_transient_gives_up(self):
+    FakeDestination.publish_comment(mox.IgnoreArg()).AndRaise(
+      urlfetch.DownloadError())
+    self.mox.ReplayAll()
+
+    comment = self.post_task(attempt=Propagate.MAX_ATTEMPTS - 1)
+    self.assertEqual('failed', comment.status)
+    self.assertIn('DownloadError', comment.failed_reason)
+    self.assertEqual([], self.taskqueue_stub.GetTasks('propagate-comments'))
+
+
+class FindPublishedTest(testutil.HandlerTest):
+
+  def setUp(self):
+    super(FindPublishedTest, self).setUp()
+    models.published_indexes.clear()
+    FakeDestination.published = []
+    self.dest = FakeDestination(key_name='http://my/blog')
+    self.dest.save()
+    self.post = FakePost(
+      key_name_parts=('9', 'Facebook', '2', 'FakeDestination', 'http://my/blog'),
+      data={'id': '9'})
+    self.post.save()
+    self.mox.StubOutWithMock(FakeDestination, 'fetch_published')
+    self.mox.StubOutWithMock(FakeDestination, 'publish_post')
+
+  def test_find_published(self):
+    FakeDestination.fetch_published().AndReturn({'FakePost:9': 'dest 9'})
+    self.mox.ReplayAll()
+
+    self.assertEqual('dest 9', self.dest.find_published(self.post))
+    # cached
+    self.assertEqual('dest 9', self.dest.find_published(self.post))
+    # stored, for other instances
+    models.published_indexes.clear()
+    self.assertEqual('dest 9', self.dest.find_published(self.post))
+    self.assertIsNotNone(models.PublishedIndex.get_by_key_name(
+        self.post.migration_key_name()))
+
+  def test_single_flight(self):
+    self.mox.ReplayAll()
+    memcache.add('published_index_lock %s' % self.post.migration_key_name(),
+                 True)
+    self.assertRaises(errors.RateLimited, self.dest.find_published, self.post)
+
+  def test_refetch_since(self):
+    FakeDestination.fetch_published().AndReturn({})
+    FakeDestination.fetch_published().AndReturn({'FakePost:9': 'dest 9'})
+    self.mox.ReplayAll()
+
+    self.assertIsNone(self.dest.find_published(self.post))
+    self.assertEqual('dest 9', self.dest.find_published(
+        self.post, since=datetime.datetime.now()))
+
+  def test_propagate_skips_published_post(self):
+    FakeDestination.fetch_published().AndReturn({'FakePost:9': 'dest 9'})
+    self.mox.ReplayAll()
+
+    Propagate.propagate(self.post.key())
+    post = db.get(self.post.key())
+    self.assertEqual('complete', post.status)
+    self.assertEqual('dest 9', post.dest_id)
+
+  def test_refetch_after_publish_started(self):
+    FakeDestination.fetch_published().AndReturn({})
+    FakeDestination.publish_post(mox.IgnoreArg()).AndRaise(
+      urlfetch.DownloadError())
+    FakeDestination.fetch_published().AndReturn({'FakePost:9': 'dest 9'})
+    self.mox.ReplayAll()
+
+    self.assertRaises(urlfetch.DownloadError, Propagate.propagate,
+                      self.post.key())
+    self.assertIsNotNone(db.get(self.post.key()).publish_started)
+
+    Propagate.propagate(self.post.key())
+    self.assertEqual('dest 9', db.get(self.post.key()).dest_id)
+
+  def test_no_refetch_after_rate_limited(self):
+    self.mox.StubOutWithMock(ratelimit.TokenBucket, 'wait')
+    FakeDestination.fetch_published().AndReturn({})
+    ratelimit.TokenBucket.wait(mox.IgnoreArg()).AndReturn(5)
+    ratelimit.TokenBucket.wait(mox.IgnoreArg()).AndReturn(0)
+    FakeDestination.publish_post(mox.IgnoreArg()).AndReturn('dest 9')
+    self.mox.ReplayAll()
+
+    self.assertRaises(errors.RateLimited, Propagate.propagate, self.post.key())
+    self.assertIsNone(db.get(self.post.key()).publish_started)
+
+    Propagate.propagate(self.post.key())
+    self.assertEqual('dest 9', db.get(self.post.key()).dest_id)
+
+
+class PublishCommentsBatchTest(testutil.HandlerTest):
+
+  def test_publish_comments_batch(self):
+    dest = FakeDestination(key_name='http://my/blog')
+    dest.save()
+    parts = ('Facebook', '2', 'FakeDestination', 'http://my/blog')
+    comments = [FakeComment(key_name_parts=(id,) + parts, data={'id': id})
+                for id in ('1', '2', '3')]
+    db.put(comments)
+
+    self.mox.StubOutWithMock(FakeDestination, 'publish_comments')
+    FakeDestination.publish_comments(mox.Func(
+        lambda cs: [c.id() for c in cs] == ['1', '2', '3'])).AndReturn(
+      ['dest 1', xmlrpclib.Fault(403, 'Forbidden'), urlfetch.DownloadError()])
+    self.mox.ReplayAll()
+
+    Propagate.publish_comments_batch([c.key() for c in comments], dest)
+    self.assertEqual(
+      [('complete', 'dest 1'), ('failed', None), ('new', None)],
+      [(c.status, c.dest_id) for c in db.get([c.key() for c in comments])])
+
+    # only the transient failure gets a task to retry it
+    retries = self.taskqueue_stub.GetTasks('propagate-comments')
+    self.assertEqual(1, len(retries))
+    self.assertEqual(comments[2].key().name(),
+                     testutil.get_task_params(retries[0])['key_name'])
+
+  def test_lease_contention(self):
+    dest = FakeDestination(key_name='http://my/blog')
+    dest.save()
+    parts = ('Facebook', '2', 'FakeDestination', 'http://my/blog')
+    comments = [FakeComment(key_name_parts=(id,) + parts, data={'id': id})
+                for id in ('1', '2')]
+    db.put(comments)
+    lease = Propagate.lease
+
+    def contended_lease(key, **kwargs):
+      if key == comments[1].key():
+        raise db.TransactionFailedError()
+      return lease(key, **kwargs)
+
+    self.mox.stubs.Set(Propagate, 'lease', staticmethod(contended_lease))
+    Propagate.publish_comments_batch([c.key() for c in comments], dest)
+    self.assertEqual(['complete', 'new'],
+                     [c.status for c in db.get([c.key() for c in comments])])
+    retries = self.taskqueue_stub.GetTasks('propagate-comments')
+    self.assertEqual(1, len(retries))
+    self.assertEqual(comments[1].key().name(),
+                     testutil.get_task_params(retries[0])['key_name'])
@@ -0,0 +1,79 @@
+"""A token bucket rate limiter shared across instances via memcache.
+
+Each bucket holds up to burst tokens and refills at rate tokens per second.
+Its state is a (tokens, timestamp) tuple in memcache, updated with
+compare-and-set so that concurrent requests on different instances don't
+double spend. If memcache evicts a bucket, it starts over full.
+"""
+
+__author__ = ['Ryan Barrett <freedom@ryanb.org>']
+
+import logging
+import time
+
+from google.appengine.api import memcache
+
+CAS_RETRIES = 10
+# idle buckets are full anyway, so they can expire
+EXPIRATION_SECS = 60 * 60
+
+
+class TokenBucket(object):
+  """A named token bucket.
+
+  Attributes:
+    name: string
+    rate: float, tokens per second
+    burst: integer, maximum number of tokens
+  """
+
+  def __init__(self, name, rate, burst):
+    self.name = name
+    self.rate = float(rate)
+    self.burst = burst
+
+  def cache_key(self):
+    return 'token_bucket %s' % self.name
+
+  def acquire(self):
+    """Attempts to take a token.
+
+    Returns: float, 0 if a token was taken, otherwise the number of seconds
+      until one should be available
+    """
+    client = memcache.Client()
+    key = self.cache_key()
+
+    for _ in range(CAS_RETRIES):
+      now = time.time()
+      state = client.gets(key)
+      if state is None:
+        if client.add(key, (self.burst - 1, now), time=EXPIRATION_SECS):
+          return 0
+        continue
+
+      tokens, last = state
+      tokens = min(self.burst, tokens + (now - last) * self.rate)
+      if tokens < 1:
+        return (1 - tokens) / self.rate
+      if client.cas(key, (tokens - 1, now), time=EXPIRATION_SECS):
+        return 0
+
+    logging.warning('Too much contention on token bucket %s', self.name)
+    return 1 / self.rate
+
+  def wait(self, max_secs):
+    """Takes a token, sleeping until one is available if necessary.
+
+    Args:
+      max_secs: float, the longest to wait
+
+    Returns: float, 0 if a token was taken, otherwise the number of seconds
+      until one should be available, which is past max_secs
+    """
+    deadline = time.time() + max_secs
+    while True:
+      wait = self.acquire()
+      if not wait or time.time() + wait > deadline:
+        return wait
+      time.sleep(wait)
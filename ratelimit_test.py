@@ -0,0 +1,39 @@
+#!/usr/bin/python
+"""Unit tests for ratelimit.py.
+"""
+
+__author__ = ['Ryan Barrett <freedom@ryanb.org>']
+
+import time
+
+import ratelimit
+from webutil import testutil
+
+
+class TokenBucketTest(testutil.HandlerTest):
+
+  def test_acquire(self):
+    bucket = ratelimit.TokenBucket('foo', .01, 2)
+    self.assertEqual(0, bucket.acquire())
+    self.assertEqual(0, bucket.acquire())
+    # empty. the next token is about 100s away.
+    self.assertAlmostEqual(100, bucket.acquire(), delta=1)
+
+    # other buckets are independent
+    self.assertEqual(0, ratelimit.TokenBucket('bar', .01, 2).acquire())
+
+  def test_refill(self):
+    now = [1000]
+    self.mox.stubs.Set(time, 'time', lambda: now[0])
+
+    bucket = ratelimit.TokenBucket('foo', 1, 1)
+    self.assertEqual(0, bucket.acquire())
+    self.assertEqual(1, bucket.acquire())
+
+    now[0] += 1
+    self.assertEqual(0, bucket.acquire())
+
+  def test_wait(self):
+    bucket = ratelimit.TokenBucket('foo', .01, 1)
+    self.assertEqual(0, bucket.wait(1))
+    self.assertAlmostEqual(100, bucket.wait(1), delta=1)
@@ -0,0 +1,52 @@
+#!/usr/bin/python
+"""Unit tests for tasks.Scan and tasks.Resync.
+"""
+
+__author__ = ['Ryan Barrett <freedom@ryanb.org>']
+
+import base64
+import json
+import os
+import urlparse
+
+import models
+import tasks
+from tasks import Scan
+from webutil import testutil
+
+
+class ScanPageTest(testutil.HandlerTest):
+
+  def test_encode_decode_page(self):
+    page = json.dumps({'data': [{'id': str(i)} for i in range(100)]})
+    encoded = Scan.encode_page(page)
+    self.assertLess(len(encoded), len(page))
+    self.assertEqual(page, Scan.decode_page(encoded))
+
+  def test_finish_prefetch_too_big(self):
+    rpc = self.mox.CreateMockAnything()
+    resp = self.mox.CreateMockAnything()
+    resp.status_code = 200
+    resp.content = os.urandom(tasks.MAX_PREFETCH_BYTES)
+    rpc.get_result().AndReturn(resp)
+    self.mox.ReplayAll()
+    self.assertIsNone(Scan.finish_prefetch(rpc))
+
+
+class ResyncTest(testutil.HandlerTest):
+
+  def test_skips_migrations_without_high_water_mark(self):
+    for id, mark, stopped in ((1, 123, False), (2, None, False),
+                              (3, 456, True)):
+      models.Migration(key_name_parts=('Facebook', str(id), 'WordPress', 'x'),
+                       id=id, sync=True, high_water_mark=mark,
+                       stopped=stopped).save()
+
+    resp = tasks.application.get_response('/cron/resync')
+    self.assertEqual(200, resp.status_int, resp.body)
+
+    scans = self.taskqueue_stub.GetTasks('scan')
+    self.assertEqual(1, len(scans))
+    params = urlparse.parse_qs(base64.b64decode(scans[0]['body']))
+    self.assertEqual({'migration': ['Facebook 1 WordPress x'],
+                      'resync': ['true']}, params)
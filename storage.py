@@ -0,0 +1,91 @@
+"""Codecs for storing decoded JSON data compactly.
+
+Used for Migratable's stored source data. Encoded values start with a one byte
+tag that identifies their codec, so values encoded with any codec can always be
+decoded, even after the default changes.
+
+Codecs:
+  json: plain JSON
+  zlib: zlib compressed JSON
+  marshal: zlib compressed marshal, a compact binary encoding. Faster to decode
+    than JSON. marshal's format is specific to the Python version, but it's
+    stable across Python 2.7 releases, which is all App Engine runs.
+"""
+
+__author__ = ['Ryan Barrett <freedom@ryanb.org>']
+
+import collections
+import json
+import marshal
+import zlib
+
+Codec = collections.namedtuple('Codec', ('name', 'tag', 'dumps', 'loads'))
+
+CODECS = (
+  Codec('json', 'j', json.dumps, json.loads),
+  Codec('zlib', 'z',
+        lambda data: zlib.compress(json.dumps(data)),
+        lambda encoded: json.loads(zlib.decompress(encoded))),
+  Codec('marshal', 'm',
+        lambda data: zlib.compress(marshal.dumps(data)),
+        lambda encoded: marshal.loads(zlib.decompress(encoded))),
+  )
+CODECS_BY_NAME = {c.name: c for c in CODECS}
+CODECS_BY_TAG = {c.tag: c for c in CODECS}
+
+# chosen based on bench_storage_codecs() in benchmark.py. zlib is the smallest,
+# about half the size of plain JSON. marshal decodes faster but is ~10% bigger,
+# and these blobs' storage cost matters more than decoding CPU.
+DEFAULT_CODEC = 'zlib'
+
+
+def prune(data, schema):
+  """Returns a copy of data with only the fields in a schema.
+
+  Schemas are True, which keeps the value as is, or a dict that maps field
+  names to schemas for those fields' values. Fields that aren't in a dict
+  schema are dropped. A dict schema applies to each element of a list value.
+
+  Args:
+    data: decoded JSON value
+    schema: True or dict
+
+  Returns: the pruned value. Shares unpruned values with data.
+  """
+  if schema is True:
+    return data
+  elif isinstance(data, list):
+    return [prune(elem, schema) for elem in data]
+  elif isinstance(data, dict):
+    return {k: prune(v, schema[k]) for k, v in data.items() if k in schema}
+  else:
+    return data
+
+
+def encode(data, codec=DEFAULT_CODEC):
+  """Encodes data with a codec.
+
+  Args:
+    data: JSON-compatible value, e.g. a dict
+    codec: string codec name
+
+  Returns: string, the encoded data. May be binary.
+  """
+  codec = CODECS_BY_NAME[codec]
+  return codec.tag + codec.dumps(data)
+
+
+def decode(encoded):
+  """Decodes data encoded by encode(), with any codec.
+
+  Args:
+    encoded: string
+
+  Returns: the decoded value
+
+  Raises: ValueError if the codec tag is unknown
+  """
+  codec = CODECS_BY_TAG.get(encoded[:1])
+  if not codec:
+    raise ValueError('Unknown codec tag %r' % encoded[:1])
+  return codec.loads(encoded[1:])
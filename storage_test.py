@@ -0,0 +1,59 @@
+#!/usr/bin/python
+"""Unit tests for storage.py.
+"""
+
+__author__ = ['Ryan Barrett <freedom@ryanb.org>']
+
+import json
+import unittest
+
+import storage
+
+DATA = {
+  'id': '212038_10100419679016683',
+  'from': {'name': u'Ryan Barr\xe9tt', 'id': '212038'},
+  'message': 'moire patterns: the new look for spring.',
+  'comments': {'count': 2, 'data': [{'id': '1', 'message': 'foo'},
+                                    {'id': '2', 'message': None}]},
+  'created_time': '2012-11-06T23:14:20+0000',
+  }
+
+
+class StorageTest(unittest.TestCase):
+
+  def test_round_trip(self):
+    for codec in storage.CODECS:
+      encoded = storage.encode(DATA, codec=codec.name)
+      self.assertEqual(codec.tag, encoded[0])
+      self.assertEqual(DATA, storage.decode(encoded))
+
+  def test_compressed_codecs_are_smaller(self):
+    data = {'data': [DATA] * 10}
+    plain = len(storage.encode(data, codec='json'))
+    for codec in 'zlib', 'marshal':
+      self.assertLess(len(storage.encode(data, codec=codec)), plain)
+
+  def test_default_codec(self):
+    self.assertEqual(storage.encode(DATA, codec=storage.DEFAULT_CODEC),
+                     storage.encode(DATA))
+
+  def test_prune(self):
+    schema = {'id': True,
+              'from': {'name': True},
+              'comments': {'data': {'id': True, 'message': True}}}
+    self.assertEqual({
+        'id': '212038_10100419679016683',
+        'from': {'name': u'Ryan Barr\xe9tt'},
+        'comments': {'data': [{'id': '1', 'message': 'foo'},
+                              {'id': '2', 'message': None}]},
+        }, storage.prune(DATA, schema))
+
+  def test_prune_keeps_everything(self):
+    self.assertIs(DATA, storage.prune(DATA, True))
+
+  def test_unknown_tag(self):
+    self.assertRaises(ValueError, storage.decode, json.dumps(DATA))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -3,12 +3,17 @@
 
 __author__ = ['Ryan Barrett <freedom@ryanb.org>']
 
+import base64
+import collections
 import datetime
 import itertools
 import json
 import logging
+import Queue
 import re
+import threading
 import time
+import zlib
 from webob import exc
 
 # need to import model class definitions since scan creates and saves entities.
@@ -24,6 +29,7 @@ from google.appengine.api import taskqueue
 import webapp2
 
 import appengine_config
+import errors
 
 
 # Unit tests use NOW_FN (below) to inject a fake for datetime.datetime.now. Lots
@@ -54,16 +60,82 @@ NOW_FN = datetime.datetime.now
 # time between propagate requests for posts and comments from a single source
 POST_DELAY_SECS = 1
 
+# Scan prefetches at most one page ahead and carries it in the next scan task's
+# params, compressed. Pages bigger than this are dropped and fetched again by
+# the next task instead, since push tasks are limited to 100KB.
+MAX_PREFETCH_BYTES = 80 * 1024
+
+
+# pull queue worker mode. the worker publishes this many posts and comments
+# concurrently, and cron starts a new worker every 10m, so it exits after 9m.
+WORKER_THREADS = 8
+WORKER_SECS = 9 * 60
+
+# if nonzero, Propagate publishes a post's comments right after the post, this
+# many at a time, instead of leaving them to their own propagate tasks.
+COMMENT_THREADS = 0
+
+
+def run_in_threads(fn, items, num_threads):
+  """Calls fn on each item, with at most num_threads calls running at once.
+
+  Args:
+    fn: callable that takes one argument
+    items: sequence
+    num_threads: integer
+
+  Returns: list with fn's return value for each item, in order, or the
+    exception it raised
+  """
+  results = [None] * len(items)
+  indices = Queue.Queue()
+  for i in range(len(items)):
+    indices.put(i)
+
+  def work():
+    while True:
+      try:
+        i = indices.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        results[i] = fn(items[i])
+      except Exception, e:
+        results[i] = e
+
+  threads = [threading.Thread(target=work)
+             for _ in range(min(num_threads, len(items)))]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return results
+
 
 class Scan(webapp2.RequestHandler):
   """Task handler that fetches and processes posts for a single migration.
 
   Inserts a propagate task for each new post for this migration.
 
+  Scanning is pipelined: while the current page is stored, the next page is
+  fetched in the background and passed along to the next scan task, so that it
+  can start storing immediately.
+
   Request parameters:
     migration: string key name of Migration entity
     scan_url: source API URL to use to scan. usually includes the current paging
       parameters.
+    page: optional, the prefetched response body for scan_url, compressed and
+      base64 encoded with encode_page()
+    resync: optional, 'true' if this is an incremental re-sync scan. Re-sync
+      scans start after the migration's high-water mark and stop at the first
+      page with a post that's already stored. Migrations without a mark, ie
+      whose sources don't support re-syncs, aren't re-synced.
+    shard: optional, integer index of this scan's shard. The initial scan of a
+      migration may be split into time slices, each scanned by its own chain of
+      tasks in parallel. Defaults to 0.
+    since, until: optional, integer UTC Unix timestamps, this shard's time
+      window. Empty means unbounded.
   """
 
   def post(self):
@@ -77,99 +149,501 @@ class Scan(webapp2.RequestHandler):
     logging.info('Getting source and dest')
     source = migration.source()
 
+    resync = self.request.get('resync') == 'true'
+    if resync and migration.high_water_mark is None:
+      logging.warning('No high-water mark to re-sync from. Dropping task.')
+      return
+
+    shard = int(self.request.get('shard', 0))
+    window = None
+    if self.request.get('since') or self.request.get('until'):
+      window = tuple(int(self.request.get(p)) if self.request.get(p) else None
+                     for p in ('since', 'until'))
+
     scan_url = self.request.get('scan_url')
-    logging.info('Scanning %s', scan_url)
-    posts, next_scan_url = source.get_posts(migration, scan_url=scan_url)
-    for i, post in enumerate(posts):
-      # this will add a propagate task if the post is new (to us)
-      post.get_or_save(task_countdown=i)
-      # XXX REMOVE, FOR TESTING ONLY
-      if post.to_activity()['published'] < '2013-02':
-        next_scan_url = None
-        break
-      # XXX
+    if resync and not scan_url:
+      scan_url = source.resync_url(migration)
+
+    page = self.request.get('page')
+    if page:
+      logging.info('Scanning prefetched page for %s', scan_url)
+      page = self.decode_page(page)
+    else:
+      logging.info('Scanning %s', scan_url)
+      page = None
+    posts, next_scan_url = source.get_posts(migration, scan_url=scan_url,
+                                            page=page, window=window)
+
+    # start fetching the next page while we store this one. re-syncs usually
+    # stop after one page, so don't waste a fetch on them.
+    rpc = (source.prefetch(next_scan_url)
+           if next_scan_url and not resync else None)
+
+    # this adds propagate tasks for the posts that are new (to us)
+    stored = models.Migratable.get_or_save_all(posts)
+
+    mark = source.get_high_water_mark(posts)
+    if mark is not None:
+      migration.raise_high_water_mark(mark)
+
+    # get_or_save_all() returns the existing entity for posts that were
+    # already stored, in any status
+    if resync and any(s is not p for p, s in zip(posts, stored)):
+      logging.info('Reached already stored posts, done re-syncing.')
+      next_scan_url = None
 
     # add next scan task
     if next_scan_url:
       new_params = dict(self.request.params)
       new_params['scan_url'] = next_scan_url
+      new_params.pop('page', None)
+      countdown = len(posts) * POST_DELAY_SECS
+
+      next_page = self.finish_prefetch(rpc) if rpc else None
+      if next_page:
+        # the next page is already fetched, so its task can start right away.
+        # the propagate queue's rate still paces publishing.
+        new_params['page'] = next_page
+        countdown = 0
+
       logging.info('Adding next scan task at %s', next_scan_url)
-      taskqueue.add(queue_name='scan', params=new_params,
-                    countdown=len(posts) * POST_DELAY_SECS)
-    else:
+      taskqueue.add(queue_name='scan', params=new_params, countdown=countdown)
+    elif resync:
+      logging.info('No next page, done re-syncing!')
+    elif migration.finish_shard(shard):
       logging.info('No next page, done scanning!')
+    else:
+      logging.info('No next page, done scanning shard %d. Other shards are '
+                   'still running.', shard)
+
+  @staticmethod
+  def finish_prefetch(rpc):
+    """Waits for a prefetch RPC to finish and encodes its response.
+
+    Returns: string encoded page, or None if the fetch failed or the page is too
+      big to pass in a task.
+    """
+    try:
+      resp = rpc.get_result()
+    except Exception:
+      logging.warning('Prefetch failed; next scan task will refetch.',
+                      exc_info=True)
+      return None
+
+    if resp.status_code != 200:
+      logging.warning('Prefetch returned HTTP %s; next scan task will refetch.',
+                      resp.status_code)
+      return None
+
+    page = Scan.encode_page(resp.content)
+    if len(page) > MAX_PREFETCH_BYTES:
+      logging.info('Prefetched page is %d bytes encoded, too big to pass along.',
+                   len(page))
+      return None
+
+    return page
+
+  @staticmethod
+  def encode_page(page):
+    """Compresses and base64 encodes a page for passing in task params."""
+    return base64.b64encode(zlib.compress(page))
+
+  @staticmethod
+  def decode_page(encoded):
+    """Inverse of encode_page()."""
+    return zlib.decompress(base64.b64decode(encoded))
+
+
+class Resync(webapp2.RequestHandler):
+  """Cron handler that starts a re-sync scan for every syncing migration.
+
+  Skips migrations without a high-water mark, since their sources can't tell
+  where the last scan left off, so each re-sync would start from the first
+  page. See Scan for details on re-sync scans.
+  """
+
+  def get(self):
+    query = models.Migration.all().filter('sync =', True)\
+        .filter('stopped =', False)
+    tasks = [taskqueue.Task(params={'migration': m.key().name(),
+                                    'resync': 'true'})
+             for m in query if m.high_water_mark is not None]
+    logging.info('Adding %d re-sync scan tasks', len(tasks))
+
+    queue = taskqueue.Queue('scan')
+    for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+      queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
 
 
 class Propagate(webapp2.RequestHandler):
   """Task handler that propagates a single post or comment.
 
+  Uses two datastore round trips per item, each a get and a put: lease(),
+  which also fetches the destination, and complete(), which also stores the
+  destination id. Posts that aren't published yet take one more,
+  start_publish().
+
+  Permanent errors, as classified by errors.is_permanent(), mark the post or
+  comment failed. Transient errors re-add the task with exponential backoff,
+  up to MAX_ATTEMPTS times, and then mark it failed too. If the destination's
+  rate limiter makes it wait too long, it re-adds the task for when the rate
+  limiter should allow it, which doesn't count as an attempt.
+
   Request parameters:
     kind: string kind
     key_name: string key name
+    attempt: integer, the number of attempts so far. Defaults to 0.
   """
 
-  # request deadline (10m) plus some padding
+  MAX_ATTEMPTS = 10
+  # see complete_all()
+  COMPLETE_ATTEMPTS = 3
+
+  # request deadline (10m) plus some padding. the longest possible lease.
   LEASE_LENGTH = datetime.timedelta(minutes=12)
 
-  def get_entity(self):
-    return db.get(db.Key.from_path(self.request.params['kind'],
-                                   self.request.params['key_name']))
+  # Leases are sized from the destination's recent publish latencies, stored in
+  # memcache, so that crashed tasks' posts and comments are retried quickly.
+  # While publishing, a heartbeat thread extends the lease every third of its
+  # length, so slow publishes, e.g. big media uploads, keep it.
+  MIN_LEASE_LENGTH = datetime.timedelta(seconds=30)
+  LATENCY_SAMPLES = 50
+  MIN_LATENCY_SAMPLES = 5
+  LATENCY_PERCENTILE = .95
+  LATENCY_MULTIPLIER = 4
+
+  def entity_key(self):
+    return db.Key.from_path(self.request.params['kind'],
+                            self.request.params['key_name'])
 
   def post(self):
     logging.debug('Params: %s', self.request.params)
+    key = self.entity_key()
+    attempt = int(self.request.get('attempt', 0))
 
     try:
-      entity = self.lease()
-      dest = entity.dest()
-      if entity:
-        # TODO: port to ndb and use caching
-        # TODO: make transactional (and add destination lookup first)
-        if entity.TYPE == 'post':
-          entity.dest_id = dest.publish_post(entity)
-          entity.save()
-          for i, cmt in enumerate(entity.get_comments()):
-            cmt.dest_post_id = entity.dest_id
-            # this will add a propagate task if the comment is new (to us)
-            cmt.get_or_save(task_countdown=i)
-        elif entity.TYPE == 'comment':
-          entity.dest_id = dest.publish_comment(entity)
-          entity.save()
-        else:
-          logging.error('Skipping unknown type %s', entity.TYPE)
-        self.complete()
+      self.propagate(key)
+    except exc.HTTPConflict:
+      raise
+    except errors.RateLimited, e:
+      logging.info('%s', e)
+      self.retry(key, attempt, e.retry_secs)
     except Exception, e:
       logging.exception('Propagate task failed')
-      if not isinstance(e, exc.HTTPConflict):
-        self.release()
-      raise
+      attempt += 1
+      if attempt >= self.MAX_ATTEMPTS:
+        self.fail(key, 'Gave up after %d attempts. Last error: %s' %
+                  (attempt, errors.describe(e)))
+        return
+      self.retry(key, attempt, errors.backoff(attempt))
 
-  @db.transactional
-  def lease(self):
+  def retry(self, key, attempt, countdown):
+    """Re-adds this task to its queue, with our own backoff.
+
+    Args:
+      key: db.Key of the post or comment
+      attempt: integer, the number of attempts so far
+      countdown: float seconds
+    """
+    logging.info('Retrying in %ds', countdown)
+    params = {'kind': key.kind(), 'key_name': key.name(), 'attempt': attempt}
+    queue = self.request.headers.get('X-AppEngine-QueueName',
+                                     'propagate-posts')
+    taskqueue.Task(url=self.request.path, params=params,
+                   countdown=countdown).add(queue_name=queue)
+
+  @classmethod
+  def propagate(cls, key):
+    """Leases, publishes, and completes a single post or comment.
+
+    If it fails permanently, marks it failed. If anything else fails, releases
+    the lease, unless another task holds it, and re-raises the exception.
+
+    Args:
+      key: db.Key of the post or comment
+    """
+    dest_key = models.Migratable.dest_key_for(key)
+    lease_length = cls.lease_length(dest_key)
+    try:
+      entity, dest = cls.lease(key, dest_key, lease_length=lease_length)
+      if entity:
+        dest_id = cls.publish_with_heartbeat(entity, dest, lease_length)
+        cls.complete(key, entity.leased_at, dest_id)
+    except Exception, e:
+      if isinstance(e, exc.HTTPConflict):
+        raise
+      elif errors.is_permanent(e):
+        logging.exception('Permanent failure propagating %s', key)
+        cls.fail(key, errors.describe(e))
+      else:
+        cls.release(key)
+        raise
+
+  @classmethod
+  def lease_length(cls, dest_key):
+    """Returns the lease length for a destination's posts and comments.
+
+    LATENCY_MULTIPLIER times the LATENCY_PERCENTILE of its recent publish
+    latencies, between MIN_LEASE_LENGTH and LEASE_LENGTH. LEASE_LENGTH if there
+    aren't enough samples yet.
+
+    Args:
+      dest_key: db.Key
+
+    Returns: datetime.timedelta
+    """
+    latencies = models.get_samples(cls.latencies_samples_name(dest_key))
+    if len(latencies) < cls.MIN_LATENCY_SAMPLES:
+      return cls.LEASE_LENGTH
+
+    latencies = sorted(latencies)
+    latency = latencies[int(cls.LATENCY_PERCENTILE * (len(latencies) - 1))]
+    length = datetime.timedelta(seconds=latency * cls.LATENCY_MULTIPLIER)
+    return min(max(length, cls.MIN_LEASE_LENGTH), cls.LEASE_LENGTH)
+
+  @classmethod
+  def record_latency(cls, dest_key, secs):
+    """Adds a publish latency sample for a destination.
+
+    Args:
+      dest_key: db.Key
+      secs: float
+    """
+    models.record_sample(cls.latencies_samples_name(dest_key), secs,
+                         max_samples=cls.LATENCY_SAMPLES)
+
+  @staticmethod
+  def latencies_samples_name(dest_key):
+    return 'publish_latencies %s' % dest_key
+
+  @classmethod
+  def publish_with_heartbeat(cls, entity, dest, lease_length):
+    """Runs publish() while a heartbeat thread extends the entity's lease.
+
+    Args:
+      entity: leased Migratable
+      dest: Destination
+      lease_length: datetime.timedelta
+
+    Returns: string destination id, from publish()
+    """
+    stop = threading.Event()
+    interval = lease_length.total_seconds() / 3
+
+    def heartbeat():
+      while not stop.wait(interval):
+        try:
+          cls.renew(entity.key(), entity.leased_at, lease_length)
+        except exc.HTTPConflict:
+          logging.warning('Lost the lease on %s', entity.key(), exc_info=True)
+          return
+        except Exception:
+          logging.exception('Renewing lease on %s failed', entity.key())
+
+    thread = threading.Thread(target=heartbeat)
+    thread.start()
+    try:
+      return cls.publish(entity, dest)
+    finally:
+      stop.set()
+      thread.join()
+
+  @classmethod
+  def publish(cls, entity, dest):
+    """Publishes a leased post or comment to its destination.
+
+    Waits for the destination's rate limiter before publishing. Skips posts
+    that Destination.find_published() says are already published. If it's a
+    post, also saves its comments and adds propagate tasks for the ones that
+    are new. If COMMENT_THREADS is set, also publishes them with
+    publish_comments(), and the tasks only retry the ones that fail. If the
+    destination has BATCH_COMMENTS, publishes them with publish_comments()
+    first, and only adds tasks for the ones that fail.
+
+    Records the latency of the publish_post() or publish_comment() call
+    itself, for lease_length().
+
+    Args:
+      entity: Migratable
+      dest: Destination
+
+    Returns: string destination id, or None if the type is unknown
+
+    Raises: errors.RateLimited if rate limited for too long
+    """
+    # TODO: port to ndb and use caching
+    if entity.TYPE == 'post':
+      # if a previous attempt started publishing, it may have published the
+      # post before it died, so make sure the index of published posts
+      # includes it.
+      dest_id = dest.find_published(entity, since=entity.publish_started)
+      if dest_id:
+        logging.info('Already published as %s', dest_id)
+      else:
+        dest.wait_for_rate_limit()
+        cls.start_publish(entity.key())
+        start = time.time()
+        dest_id = dest.publish_post(entity)
+        cls.record_latency(dest.key(), time.time() - start)
+        dest.add_published(entity, dest_id)
+
+      comments = list(entity.get_comments())
+      for cmt in comments:
+        cmt.dest_post_id = dest_id
+      if dest.BATCH_COMMENTS:
+        # publish_comments_batch() adds tasks for the ones it doesn't finish
+        comments = models.Migratable.get_or_save_all(comments, add_tasks=False)
+        cls.publish_comments(comments, dest)
+      elif COMMENT_THREADS:
+        # the propagate tasks wait until these leases would have expired
+        comments = models.Migratable.get_or_save_all(
+          comments, task_countdown=cls.LEASE_LENGTH.seconds)
+        cls.publish_comments(comments, dest)
+      else:
+        # this adds propagate tasks for the comments that are new (to us)
+        models.Migratable.get_or_save_all(comments)
+      return dest_id
+    elif entity.TYPE == 'comment':
+      dest.wait_for_rate_limit()
+      start = time.time()
+      dest_id = dest.publish_comment(entity)
+      cls.record_latency(dest.key(), time.time() - start)
+      return dest_id
+    else:
+      logging.error('Skipping unknown type %s', entity.TYPE)
+
+  @classmethod
+  def publish_comments(cls, comments, dest):
+    """Propagates a post's new comments, COMMENT_THREADS at a time.
+
+    If the destination has ORDERED_COMMENTS, publishes them one at a time
+    instead, oldest first. Each comment is leased and completed individually
+    by propagate(). Failures are logged, and left for the comments' propagate
+    tasks to retry.
+
+    If the destination has BATCH_COMMENTS, publishes them all together with
+    publish_comments_batch() instead.
+
+    Args:
+      comments: sequence of stored Migratable comments
+      dest: Destination
+    """
+    new = [c for c in comments if c.status == 'new']
+    num_threads = COMMENT_THREADS
+    if dest.ORDERED_COMMENTS:
+      new.sort(key=lambda c: c.to_activity()['object'].get('published', ''))
+      num_threads = 1
+
+    if dest.BATCH_COMMENTS:
+      cls.publish_comments_batch([c.key() for c in new], dest)
+      return
+
+    results = run_in_threads(cls.propagate, [c.key() for c in new], num_threads)
+    for comment, result in zip(new, results):
+      if isinstance(result, Exception):
+        logging.error('Propagating comment %s failed: %r', comment.key(),
+                      result)
+
+  @classmethod
+  def publish_comments_batch(cls, keys, dest):
+    """Propagates comments with a single Destination.publish_comments() call.
+
+    Leases the comments individually, then publishes all of the leased ones
+    and completes the ones that succeeded with one batch write, even if
+    something else fails. Permanent failures are marked failed. Other failures
+    are released. The comments don't have propagate tasks, so this adds them
+    for the ones that are still new afterward, e.g. released or not leased
+    because of contention.
+
+    Args:
+      keys: sequence of db.Key of comments, in the order to publish them
+      dest: Destination. Its publish_comments() waits for its rate limiter.
+    """
+    leased = []
+    for key in keys:
+      try:
+        entity, _ = cls.lease(key)
+      except (exc.HTTPConflict, exc.HTTPExpectationFailed,
+              db.TransactionFailedError):
+        logging.warning('Could not lease %s', key, exc_info=True)
+        continue
+      if entity:
+        leased.append(entity)
+
+    completed = []
+    try:
+      if leased:
+        try:
+          results = dest.publish_comments(leased)
+        except Exception, e:
+          logging.exception('Publishing comments failed')
+          results = [e] * len(leased)
+
+        for comment, result in zip(leased, results):
+          if not isinstance(result, Exception):
+            completed.append((comment, result))
+          elif errors.is_permanent(result):
+            cls.fail(comment.key(), errors.describe(result))
+          else:
+            logging.error('Propagating comment %s failed: %r', comment.key(),
+                          result)
+            cls.release(comment.key())
+    finally:
+      cls.complete_all(completed)
+
+    done = set(comment.key() for comment, _ in completed)
+    retry = [key for key in keys if key not in done]
+    if retry:
+      models.Migratable.add_propagate_tasks(filter(None, db.get(retry)))
+
+  @classmethod
+  @db.transactional(xg=True)
+  def lease(cls, key, dest_key=None, lease_length=None):
     """Attempts to acquire and lease the post or comment entity.
 
-    Returns the entity on success, otherwise None.
+    Args:
+      key: db.Key of the post or comment
+      dest_key: db.Key of its destination, optional. If provided, the
+        destination is fetched in the same batch get.
+      lease_length: datetime.timedelta, defaults to LEASE_LENGTH
+
+    Returns (entity, destination) on success, otherwise (None, None).
+      destination is None if dest_key wasn't provided.
     """
-    entity = self.get_entity()
+    entity, dest = db.get([key, dest_key]) if dest_key else (db.get(key), None)
 
     if entity is None:
       raise exc.HTTPExpectationFailed('entity not found!')
     elif entity.status == 'complete':
       # let this response return 200 and finish
       logging.warning('duplicate task already propagated post/comment')
+    elif entity.status == 'failed':
+      logging.warning('post/comment already failed: %s', entity.failed_reason)
     elif entity.status == 'processing' and NOW_FN() < entity.leased_until:
       raise exc.HTTPConflict('duplicate task is currently processing!')
     else:
       assert entity.status in ('new', 'processing')
       entity.status = 'processing'
-      entity.leased_until = NOW_FN() + self.LEASE_LENGTH
+      entity.leased_at = NOW_FN()
+      entity.leased_until = NOW_FN() + (lease_length or cls.LEASE_LENGTH)
       entity.save()
-      return entity
+      return entity, dest
+
+    return None, None
 
+  @staticmethod
   @db.transactional
-  def complete(self):
+  def complete(key, leased_at, dest_id):
     """Attempts to mark the post or comment entity completed.
+
+    Args:
+      key: db.Key of the post or comment
+      leased_at: datetime, the leased_at of the lease from lease()
+      dest_id: string, the destination id of the propagated post or comment
+
+    Raises: HTTPConflict if another task has leased it since
     """
-    entity = self.get_entity()
+    entity = db.get(key)
 
     if entity is None:
       raise exc.HTTPExpectationFailed('entity disappeared!')
@@ -177,26 +651,393 @@ class Propagate(webapp2.RequestHandler):
       # let this response return 200 and finish
       logging.warning('post/comment stolen and finished. did my lease expire?')
       return
+    elif entity.leased_at != leased_at:
+      raise exc.HTTPConflict('lease expired and another task re-leased it!')
     elif entity.status == 'new':
       raise exc.HTTPExpectationFailed(
         'post/comment went backward from processing to new!')
 
     assert entity.status == 'processing'
     entity.status = 'complete'
+    entity.dest_id = dest_id
     entity.save()
 
+  @staticmethod
+  @db.transactional
+  def start_publish(key):
+    """Records that a post is about to be published, in publish_started.
+
+    Args:
+      key: db.Key of the post
+    """
+    entity = db.get(key)
+    if entity:
+      entity.publish_started = NOW_FN()
+      entity.save()
+
+  @staticmethod
+  @db.transactional
+  def renew(key, leased_at, lease_length):
+    """Extends the lease on a post or comment entity if it's still processing.
+
+    Args:
+      key: db.Key of the post or comment
+      leased_at: datetime, the leased_at of the lease from lease()
+      lease_length: datetime.timedelta
+
+    Raises: HTTPConflict if another task has leased it since
+    """
+    entity = db.get(key)
+    if entity and entity.status == 'processing':
+      if entity.leased_at != leased_at:
+        raise exc.HTTPConflict('lease expired and another task re-leased it!')
+      entity.leased_until = NOW_FN() + lease_length
+      entity.save()
+    else:
+      logging.warning('post/comment %s is no longer processing!', key)
+
+  @classmethod
+  def complete_all(cls, completed):
+    """Batch version of complete(), with one get and one put.
+
+    This isn't transactional, unlike complete(). Instead, it skips entities
+    that aren't processing under the same lease any more, ie whose leased_at
+    has changed, e.g. because the lease expired and another task re-leased
+    them. Only a re-lease between the get and the put can be overwritten.
+
+    Datastore errors are retried, up to COMPLETE_ATTEMPTS attempts in all. The
+    entities are already published, so they're never released. If every
+    attempt fails, they stay processing until their leases expire.
+
+    Args:
+      completed: sequence of (Migratable, string destination id) tuples. Each
+        Migratable is as returned by lease().
+    """
+    if not completed:
+      return
+
+    keys = [leased.key() for leased, _ in completed]
+    for attempt in range(1, cls.COMPLETE_ATTEMPTS + 1):
+      try:
+        updated = []
+        for (leased, dest_id), entity in zip(completed, db.get(keys)):
+          if (entity is None or entity.status != 'processing' or
+              entity.leased_at != leased.leased_at):
+            logging.warning('post/comment %s is %s, not completing it',
+                            leased.key(), entity.status if entity else 'gone')
+            continue
+          entity.status = 'complete'
+          entity.dest_id = dest_id
+          updated.append(entity)
+
+        db.put(updated)
+        return
+      except db.Error:
+        if attempt == cls.COMPLETE_ATTEMPTS:
+          raise
+        logging.warning('Completing %d entities failed, retrying',
+                        len(completed), exc_info=True)
+
+  @staticmethod
+  @db.transactional
+  def fail(key, reason):
+    """Marks the post or comment entity failed, permanently.
+
+    Args:
+      key: db.Key of the post or comment
+      reason: string
+    """
+    logging.error('Marking %s failed: %s', key, reason)
+    entity = db.get(key)
+    if entity and entity.status != 'complete':
+      entity.status = 'failed'
+      entity.failed_reason = reason
+      entity.leased_until = None
+      entity.save()
+
+  @staticmethod
   @db.transactional
-  def release(self):
+  def release(key):
     """Attempts to release the lease on the post or comment entity.
+
+    Args:
+      key: db.Key of the post or comment
     """
-    entity = self.get_entity()
+    entity = db.get(key)
     if entity and entity.status == 'processing':
       entity.status = 'new'
       entity.leased_until = None
       entity.save()
 
 
+class PropagateBatch(webapp2.RequestHandler):
+  """Task handler that propagates a batch of new posts or comments.
+
+  Propagates up to BATCH_SIZE new entities of one kind in one migration, all to
+  the same destination instance, then completes them with a single batch
+  write. Each entity is leased and released individually, like Propagate, so
+  if some fail transiently, only those are left new. The task then fails, and
+  its retry, with the propagate queue's backoff, picks them up again. Permanent
+  failures are marked failed. So are transient failures in the task's last
+  attempt, Propagate.MAX_ATTEMPTS, after which the propagate queue's
+  task_retry_limit drops it. If the destination's rate limiter makes it wait
+  too long, it stops and adds a new task for when the rate limiter should allow
+  it, which doesn't count as an attempt. If the batch was full, adds another
+  task for the next one. Unless it was added by Dispatch, it adds these tasks
+  with Migration.add_propagate_batch_task(), so they're merged with the tasks
+  that new posts and comments add.
+
+  The entities that were published are completed even if the task fails
+  partway through, so they don't stay processing until Sweep re-drives them.
+
+  Records how long each task waited in the queue, per migration, with
+  models.record_sample().
+
+  Request parameters:
+    kind: string kind
+    migration: string Migration key name
+    enqueued: float Unix timestamp when the task was added
+    fair: if set, this task was added by Dispatch, which adds the next batch
+      itself, so this doesn't.
+  """
+
+  BATCH_SIZE = 20
+  # see Migration.remove_pending_kind()
+  PENDING_MIN_AGE = datetime.timedelta(minutes=1)
+
+  def post(self):
+    logging.debug('Params: %s', self.request.params)
+    kind = self.request.params['kind']
+    migration = models.Migration.get_by_key_name(
+      self.request.params['migration'])
+    if not migration:
+      raise exc.HTTPExpectationFailed('migration not found!')
+
+    enqueued = self.request.get('enqueued')
+    if enqueued:
+      wait = time.time() - float(enqueued)
+      logging.info('Waited %.1fs in the queue', wait)
+      models.record_sample(migration.queue_wait_samples_name(), wait)
+
+    dest = migration.dest()
+    keys = db.class_for_kind(kind).all(keys_only=True)\
+        .filter('migration =', migration.key())\
+        .filter('status =', 'new')\
+        .order('-last_updated')\
+        .fetch(self.BATCH_SIZE)
+    logging.info('Propagating %d %s entities', len(keys), kind)
+    fair = bool(self.request.get('fair'))
+    if fair and not keys:
+      models.Migration.remove_pending_kind(migration.key(), kind,
+                                           self.PENDING_MIN_AGE)
+
+    retries = self.request.headers.get('X-AppEngine-TaskRetryCount', 0)
+    attempt = int(retries) + 1
+    last_attempt = attempt >= Propagate.MAX_ATTEMPTS
+
+    # entities stay leased until the whole batch is completed
+    lease_length = min(Propagate.lease_length(dest.key()) * self.BATCH_SIZE,
+                       Propagate.LEASE_LENGTH)
+    completed = []
+    failed = []
+    rate_limited = None
+    try:
+      for key in keys:
+        try:
+          entity, _ = Propagate.lease(key, lease_length=lease_length)
+        except (exc.HTTPConflict, exc.HTTPExpectationFailed,
+                db.TransactionFailedError):
+          # leased by another task, contention, or stale query result. skip it.
+          logging.warning('Could not lease %s', key, exc_info=True)
+          continue
+        if not entity:
+          continue
+
+        try:
+          completed.append((entity, Propagate.publish_with_heartbeat(
+            entity, dest, lease_length)))
+        except errors.RateLimited, e:
+          # the rest of the batch would be too
+          logging.info('%s', e)
+          Propagate.release(key)
+          rate_limited = e
+          break
+        except Exception, e:
+          logging.exception('Propagating %s failed', key)
+          if errors.is_permanent(e):
+            Propagate.fail(key, errors.describe(e))
+          elif last_attempt:
+            Propagate.fail(key, 'Gave up after %d attempts. Last error: %s' %
+                           (attempt, errors.describe(e)))
+          else:
+            Propagate.release(key)
+            failed.append(key)
+    finally:
+      Propagate.complete_all(completed)
+
+    if failed:
+      raise exc.HTTPInternalServerError('%d of %d failed' % (len(failed),
+                                                            len(keys)))
+    elif fair:
+      return
+    elif rate_limited:
+      models.Migration.add_propagate_batch_task(
+        migration.key(), kind, countdown=rate_limited.retry_secs)
+    elif len(keys) == self.BATCH_SIZE:
+      models.Migration.add_propagate_batch_task(migration.key(), kind)
+
+
+class Dispatch(webapp2.RequestHandler):
+  """Cron handler that schedules propagation fairly across migrations.
+
+  Used when models.PROPAGATE_MODE is 'fair'. Each run adds ROUNDS rounds of
+  PropagateBatch tasks, ROUND_SECS apart. Each round has one task for each
+  pending kind of each unstopped migration, so every migration gets an equal
+  share of the propagate queue, no matter how many posts it has.
+  """
+
+  ROUNDS = 3
+  ROUND_SECS = 20
+
+  def get(self):
+    pending = [(m.key(), kind) for m in
+               models.Migration.all().filter('pending_kinds >', '')
+               if not m.stopped
+               for kind in m.pending_kinds]
+    logging.info('Dispatching %d migration kinds', len(pending))
+
+    tasks = [models.Migration.propagate_batch_task(
+               key, kind, countdown=round * self.ROUND_SECS, fair=True)
+             for round in range(self.ROUNDS)
+             for key, kind in pending]
+    queue = taskqueue.Queue('propagate')
+    for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+      queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+
+
+class PropagateWorker(webapp2.RequestHandler):
+  """Cron handler that propagates posts and comments from the pull queue.
+
+  Used when models.PROPAGATE_MODE is 'pull'. Leases tasks in bulk, propagates
+  them with Propagate.propagate() in WORKER_THREADS threads, and deletes the
+  ones that succeeded with a single batch delete. Failed tasks are left leased,
+  so they're retried after their lease expires, until they've been leased
+  Propagate.MAX_ATTEMPTS times. Then their posts or comments are marked failed.
+  Tasks that were rate limited are replaced with new tasks for when the rate
+  limiter should allow them, so that doesn't count as an attempt. Runs until
+  the queue is empty or for WORKER_SECS, whichever comes first.
+  """
+
+  MAX_TASKS = 100
+  # longer than WORKER_SECS plus the time to process the last batch of tasks
+  LEASE_SECS = Propagate.LEASE_LENGTH.seconds
+
+  def get(self):
+    queue = taskqueue.Queue('propagate-pull')
+    deadline = time.time() + WORKER_SECS
+
+    while time.time() < deadline:
+      leased = queue.lease_tasks(self.LEASE_SECS, self.MAX_TASKS)
+      if not leased:
+        break
+
+      keys = [db.Key(task.payload) for task in leased]
+      results = run_in_threads(Propagate.propagate, keys, WORKER_THREADS)
+      done = []
+      retries = []
+      for task, key, result in zip(leased, keys, results):
+        if not isinstance(result, Exception):
+          done.append(task)
+        elif isinstance(result, errors.RateLimited):
+          retries.append(taskqueue.Task(payload=task.payload, method='PULL',
+                                        countdown=result.retry_secs))
+          done.append(task)
+        elif (task.retry_count >= Propagate.MAX_ATTEMPTS and
+              not isinstance(result, exc.HTTPConflict)):
+          Propagate.fail(key, 'Gave up after %d attempts. Last error: %s' %
+                         (task.retry_count, errors.describe(result)))
+          done.append(task)
+        else:
+          logging.error('Propagating %s failed: %r', key, result)
+
+      logging.info('Finished %d of %d, %d rate limited', len(done),
+                   len(leased), len(retries))
+      if retries:
+        queue.add(retries)
+      if done:
+        queue.delete_tasks(done)
+
+
+class Sweep(webapp2.RequestHandler):
+  """Cron handler that re-drives posts and comments whose leases expired.
+
+  When a propagate task dies or gives up, its post or comment can be left
+  processing with an expired lease and no task to retry it. This finds them,
+  for every Migratable kind, in batches of BATCH_SIZE with query cursors. It
+  resets them to new and adds their propagate tasks in bulk, one
+  POST_DELAY_SECS apart per destination. Runs for at most MAX_SECS; the next
+  run picks up where it left off, since reset entities drop out of the query.
+  """
+
+  BATCH_SIZE = 100
+  MAX_SECS = 5 * 60
+
+  def get(self):
+    deadline = time.time() + self.MAX_SECS
+    # maps destination key to the next task countdown for it
+    countdowns = collections.defaultdict(int)
+    swept = 0
+
+    for cls in models.Migratable.kinds():
+      query = cls.all().filter('status =', 'processing')\
+          .filter('leased_until <', NOW_FN())
+      while time.time() < deadline:
+        entities = query.fetch(self.BATCH_SIZE)
+        if not entities:
+          break
+        swept += self.reset(entities, countdowns)
+        query.with_cursor(query.cursor())
+
+    logging.info('Re-drove %d posts and comments', swept)
+
+  @staticmethod
+  def reset(entities, countdowns):
+    """Resets entities to new and adds their propagate tasks.
+
+    Args:
+      entities: sequence of Migratables with expired leases
+      countdowns: dict mapping destination db.Key to integer countdown for its
+        next task. Updated in place.
+
+    Returns: integer, the number of entities reset
+    """
+    now = NOW_FN()
+    # re-check, since the query results may be stale
+    expired = [e for e in db.get([e.key() for e in entities])
+               if e and e.status == 'processing' and e.leased_until < now]
+    for entity in expired:
+      logging.info('Re-driving %s %s', entity.kind(), entity.key().name())
+      entity.status = 'new'
+      entity.leased_until = None
+    db.put(expired)
+
+    by_dest = collections.defaultdict(list)
+    for entity in expired:
+      by_dest[models.Migratable.dest_key_for(entity.key())].append(entity)
+    for dest_key, dest_entities in by_dest.items():
+      models.Migratable.add_propagate_tasks(
+        dest_entities, task_countdown=countdowns[dest_key])
+      countdowns[dest_key] += len(dest_entities) * POST_DELAY_SECS
+
+    return len(expired)
+
+
 application = webapp2.WSGIApplication([
     ('/_ah/queue/scan', Scan),
     ('/_ah/queue/propagate', Propagate),
+    ('/_ah/queue/propagate_batch', PropagateBatch),
+    ('/cron/resync', Resync),
+    ('/cron/propagate_worker', PropagateWorker),
+    ('/cron/sweep', Sweep),
+    ('/cron/dispatch', Dispatch),
     ], debug=appengine_config.DEBUG)
@@ -33,6 +33,9 @@ TUMBLR_APP_SECRET = appengine_config.read('tumblr_app_secret')
 OAUTH_CALLBACK_URL = '%s://%s/tumblr/oauth_callback' % (
   appengine_config.SCHEME, appengine_config.HOST)
 
+# Tumblr's maximum
+POSTS_PAGE_SIZE = 20
+
 
 class TumblrOAuthRequestToken(models.OAuthToken):
   pass
@@ -119,6 +122,8 @@ class Tumblr(models.Destination):
       'format': 'html',
       # 'title': title,
       'body': body,
+      # marks the post so fetch_published() can find it
+      'tags': self.published_marker(post),
       }
 
     # photo
@@ -141,6 +146,32 @@ class Tumblr(models.Destination):
     resp = tp.post('post', blog_url=self.hostname(), params=params)
     return str(resp['id'])
 
+  def published_marker(self, post):
+    """Tumblr lower cases tags, so lower case markers to match."""
+    return post.marker().lower()
+
+  def fetch_published(self):
+    """Fetches the marker tags on all of this blog's posts.
+
+    Returns: dict mapping marker to string Tumblr post id
+    """
+    tp = tumblpy.Tumblpy(app_key=TUMBLR_APP_KEY,
+                         app_secret=TUMBLR_APP_SECRET,
+                         oauth_token=self.token_key,
+                         oauth_token_secret=self.token_secret)
+    published = {}
+    offset = 0
+    while True:
+      # http://www.tumblr.com/docs/en/api/v2#posts
+      posts = tp.get('posts', blog_url=self.hostname(),
+                     params={'offset': offset, 'limit': POSTS_PAGE_SIZE})['posts']
+      for post in posts:
+        for tag in post.get('tags', []):
+          published[tag.lower()] = str(post['id'])
+      if len(posts) < POSTS_PAGE_SIZE:
+        return published
+      offset += len(posts)
+
   def publish_comment(self, comment):
     """Tumblr doesn't support comments, so this is a noop.
 
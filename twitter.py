@@ -4,8 +4,10 @@
 
 __author__ = ['Ryan Barrett <freedom@ryanb.org>']
 
+import datetime
 import json
 import logging
+import re
 import urllib
 import urlparse
 from webob import exc
@@ -28,6 +30,44 @@ OAUTH_CALLBACK = '%s://%s/twitter/oauth_callback?dest=%%s' % (appengine_config.S
 API_TWEETS_URL = ('https://api.twitter.com/1.1/statuses/user_timeline.json'
                   '?include_entities=true&screen_name=%s')
 
+# Tweet ids are snowflakes, which start with a millisecond timestamp relative to
+# this epoch (2010-11-04). https://github.com/twitter/snowflake
+SNOWFLAKE_EPOCH_MS = 1288834974657
+
+
+# Fields of tweets that the activitystreams converter and render_html() use.
+# See Migratable.SCHEMA. Entities are used for links, mentions and hashtags.
+# https://dev.twitter.com/docs/platform-objects/tweets
+USER_SCHEMA = dict.fromkeys(
+  ('id', 'id_str', 'screen_name', 'name', 'profile_image_url', 'url',
+   'description', 'location'), True)
+ENTITY_SCHEMA = dict.fromkeys(
+  ('id', 'id_str', 'indices', 'text', 'url', 'expanded_url', 'display_url',
+   'media_url', 'type', 'screen_name', 'name'), True)
+TWEET_SCHEMA = dict.fromkeys(
+  ('id', 'id_str', 'text', 'created_at', 'source', 'in_reply_to_status_id',
+   'in_reply_to_status_id_str', 'in_reply_to_screen_name', 'place',
+   'coordinates'), True)
+TWEET_SCHEMA.update({
+  'user': USER_SCHEMA,
+  'entities': dict.fromkeys(('hashtags', 'urls', 'user_mentions', 'media'),
+                            ENTITY_SCHEMA),
+  'replies': {'data': TWEET_SCHEMA},
+  'retweeted_status': TWEET_SCHEMA,
+  })
+
+
+def timestamp_to_id(timestamp):
+  """Returns the lowest possible tweet id at a given time.
+
+  Args:
+    timestamp: integer UTC Unix timestamp
+
+  Returns: integer tweet id, or None if timestamp is before the snowflake epoch
+  """
+  id = (timestamp * 1000 - SNOWFLAKE_EPOCH_MS) << 22
+  return id if id > 0 else None
+
 
 class TwitterOAuthRequestToken(models.OAuthToken):
   pass
@@ -37,6 +77,8 @@ class Twitter(models.Source):
   """A Twitter account. The key name is the username."""
 
   DOMAIN = 'twitter.com'
+  # tweets before this don't have snowflake ids, so they can't be windowed
+  EPOCH = datetime.datetime.utcfromtimestamp(SNOWFLAKE_EPOCH_MS / 1000)
 
   # Twitter OAuth 1.0A access token for this account
   # https://dev.twitter.com/docs/auth/3-legged-authorization
@@ -63,13 +105,15 @@ class Twitter(models.Source):
       picture=me['image']['url'],
       url=me['url'])
 
-  def get_posts(self, migration, scan_url=None):
+  def get_posts(self, migration, scan_url=None, page=None, window=None):
     """Fetches a page of tweets.
 
     Args:
       migration: Migration
       scan_url: string, the API URL to fetch the current page of tweets. If None,
         starts at the beginning.
+      page: string, the already fetched response body for scan_url, or None
+      window: (since, until) tuple of timestamps. See Source.get_posts().
 
     Returns:
       (tweets, next_scan_url). tweets is a sequence of Tweets.
@@ -85,11 +129,16 @@ class Twitter(models.Source):
     APPLICATION_BLACKLIST = ('Likes', 'Links', 'twitterfeed')
 
     if not scan_url:
-      scan_url = API_TWEETS_URL % self.key().name()
+      ids = self.window_ids(window or migration.window_timestamps())
+      if ids is None:
+        logging.info('Window ends before the snowflake epoch, no tweets.')
+        return [], None
+      scan_url = self.tweets_url(*ids)
     tw = as_twitter.Twitter(None)
-    resp = json.loads(tw.urlfetch(scan_url,
-                                  access_token_key=self.token_key,
-                                  access_token_secret=self.token_secret))
+    if page is None:
+      page = tw.urlfetch(scan_url, access_token_key=self.token_key,
+                         access_token_secret=self.token_secret)
+    resp = json.loads(page)
 
     tweets = []
     for tweet in resp:
@@ -100,24 +149,89 @@ class Twitter(models.Source):
         continue
 
       tweets.append(Tweet(key_name_parts=(str(id), migration.key().name()),
-                          json_data=json.dumps(tweet)))
+                          data=tweet))
 
+    # page backward from the oldest tweet. max_id is inclusive. since_id, if
+    # any, stays in the URL, so an empty page means we're done.
     next_scan_url = None
-    if tweets:
-      scan_url + '&max_id=%s' % tweets[-1].id()
-    # XXX remove
-    if tweets and tw.rfc2822_to_iso8601(tweets[-1].data()['created_at']) < '2013-09-01':
-      next_scan_url = None
-    # XXX
+    if resp:
+      next_scan_url = '%s&max_id=%d' % (re.sub('&max_id=\d+', '', scan_url),
+                                        resp[-1]['id'] - 1)
     return tweets, next_scan_url
 
+  def tweets_url(self, since_id=None, max_id=None):
+    """Returns the API URL for the first page of tweets in an id range.
+
+    Args:
+      since_id: integer, exclusive, or None
+      max_id: integer, inclusive, or None
+    """
+    url = API_TWEETS_URL % self.key().name()
+    if since_id is not None:
+      url += '&since_id=%d' % since_id
+    if max_id is not None:
+      url += '&max_id=%d' % max_id
+    return url
+
+  @staticmethod
+  def window_ids(window):
+    """Translates a time window to a tweet id range.
+
+    Args:
+      window: (since, until) tuple of integer UTC Unix timestamps or Nones
+
+    Returns: (since_id, max_id) tuple of integers or Nones, or None if the
+      window ends before the snowflake epoch, ie it's empty
+    """
+    since, until = window
+    since_id = timestamp_to_id(since) if since is not None else None
+    max_id = None
+    if until is not None:
+      max_id = timestamp_to_id(until)
+      if max_id is None:
+        return None
+    return (since_id - 1 if since_id is not None else None,
+            max_id - 1 if max_id is not None else None)
+
+  def resync_url(self, migration):
+    """Returns the URL for tweets newer than the high-water mark.
+
+    Returns None if the migration's window is empty, so that get_posts()
+    returns no tweets.
+    """
+    ids = self.window_ids(migration.window_timestamps())
+    if ids is None:
+      return None
+    since_id, max_id = ids
+    return self.tweets_url(since_id=max(since_id or 0, migration.high_water_mark),
+                           max_id=max_id)
+
+  def get_high_water_mark(self, tweets):
+    """Returns the newest tweet's id."""
+    if tweets:
+      return max(int(t.id()) for t in tweets)
+
+  def prefetch(self, scan_url):
+    """Starts fetching a page of tweets. See Source.prefetch()."""
+    auth = tweepy.OAuthHandler(appengine_config.TWITTER_APP_KEY,
+                               appengine_config.TWITTER_APP_SECRET)
+    auth.set_access_token(self.token_key, self.token_secret)
+    headers = {}
+    auth.apply_auth(scan_url, 'GET', headers, {})
+
+    rpc = urlfetch.create_rpc(deadline=60)
+    urlfetch.make_fetch_call(rpc, scan_url, headers=headers)
+    return rpc
+
 
 class Tweet(models.Migratable):
   """A tweet. The key name is 'TWEET_ID MIGRATION_KEY_NAME'."""
 
   TYPE = 'post'
+  SCHEMA = TWEET_SCHEMA
+  ACTIVITY_VERSION = 1
 
-  def to_activity(self):
+  def convert(self):
     """Returns an ActivityStreams activity dict for this tweet."""
     return as_twitter.Twitter(None).tweet_to_activity(self.data())
 
@@ -127,7 +241,7 @@ class Tweet(models.Migratable):
     replies = self.data().get('replies', {}).get('data', [])
     migration_key = Tweet.migration.get_value_for_datastore(self)
     return (Reply(key_name_parts=(r['id'], migration_key.name()),
-                  json_data=json.dumps(r))
+                  data=r)
             for r in replies)
 
 
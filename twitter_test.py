@@ -0,0 +1,30 @@
+#!/usr/bin/python
+"""Unit tests for twitter.py.
+"""
+
+__author__ = ['Ryan Barrett <freedom@ryanb.org>']
+
+import twitter
+from twitter import Twitter
+from webutil import testutil
+
+
+class WindowIdsTest(testutil.HandlerTest):
+
+  def test_unbounded(self):
+    self.assertEqual((None, None), Twitter.window_ids((None, None)))
+
+  def test_window(self):
+    since = twitter.SNOWFLAKE_EPOCH_MS / 1000 + 10
+    self.assertEqual((twitter.timestamp_to_id(since) - 1,
+                      twitter.timestamp_to_id(since + 10) - 1),
+                     Twitter.window_ids((since, since + 10)))
+
+  def test_since_before_epoch(self):
+    until = twitter.SNOWFLAKE_EPOCH_MS / 1000 + 10
+    self.assertEqual((None, twitter.timestamp_to_id(until) - 1),
+                     Twitter.window_ids((0, until)))
+
+  def test_until_before_epoch(self):
+    self.assertIsNone(Twitter.window_ids((None, 1000)))
+    self.assertIsNone(Twitter.window_ids((0, 1000)))
@@ -3,18 +3,22 @@
 
 __author__ = ['Ryan Barrett <freedom@ryanb.org>']
 
+import base64
 import functools
+import gzip
 import logging
 import os
 import re
+import StringIO
 import sys
 import xmlrpclib
 import urllib
-import urllib2
 import urlparse
 
 from activitystreams import activitystreams
 import appengine_config
+import errors
+import mediacache
 import models
 from webutil import util
 
@@ -22,10 +26,33 @@ from google.appengine.api import urlfetch
 from google.appengine.ext import db
 import webapp2
 
+# urlfetch deadline for XML-RPC calls, in seconds. uploads can be big.
+DEADLINE_SECS = 60
+
+# upload_file() base64 encodes this many bytes at a time. a multiple of 57, the
+# number of bytes base64 encodes into each 76 character line.
+UPLOAD_CHUNK_SIZE = 57 * 1024
+
+# XmlRpc clients, cached by WordPress.xmlrpc() and shared by all publishes to
+# the same blog in this instance.
+clients = {}
+
 
 class WordPress(models.Destination):
   """A WordPress blog. The key name is the XML-RPC URL."""
 
+  # WordPress dates comments when they're published
+  ORDERED_COMMENTS = True
+  # publish_comments() batches with system.multicall
+  BATCH_COMMENTS = True
+  # maximum number of calls in each system.multicall request
+  MULTICALL_SIZE = 50
+
+  # custom field that stores Migratable.marker() in each published post
+  MARKER_FIELD = 'freedom_source'
+  # page size for wp.getPosts in fetch_published()
+  GET_POSTS_PAGE_SIZE = 100
+
   blog_id = db.IntegerProperty(required=True)
   username = db.StringProperty(required=True)
   password = db.StringProperty(required=True)
@@ -37,6 +64,22 @@ class WordPress(models.Destination):
   def display_name(self):
     return util.domain_from_link(self.xmlrpc_url())
 
+  def xmlrpc(self):
+    """Returns the XmlRpc client for this blog, cached in clients.
+
+    The client is thread safe, so publishes in different threads can share it.
+    """
+    key = (self.xmlrpc_url(), self.blog_id, self.username, self.password)
+    client = clients.get(key)
+    if client is None:
+      url = self.xmlrpc_url()
+      transport = GAEXMLRPCTransport(scheme=urlparse.urlparse(url).scheme,
+                                     deadline=DEADLINE_SECS)
+      client = clients[key] = XmlRpc(url, self.blog_id, self.username,
+                                     self.password, verbose=True,
+                                     transport=transport)
+    return client
+
   @classmethod
   def new(cls, handler):
     """Creates and saves a WordPress entity based on query parameters.
@@ -77,8 +120,7 @@ class WordPress(models.Destination):
     obj = activity['object']
     date = util.parse_iso8601(activity['published'])
     location = obj.get('location')
-    xmlrpc = XmlRpc(self.xmlrpc_url(), self.blog_id, self.username, self.password,
-                    verbose=True, transport=GAEXMLRPCTransport())
+    xmlrpc = self.xmlrpc()
     logging.info('Publishing post %s', obj['id'])
 
     # extract title
@@ -96,15 +138,11 @@ class WordPress(models.Destination):
     image = obj.get('image', {})
     image_url = image.get('url')
     if obj.get('objectType') == 'photo' and image_url:
-      logging.info('Downloading %s', image_url)
-      resp = urllib2.urlopen(image_url)
-      data = resp.read()
-      logging.debug('downloaded %d bytes', len(data))
       filename = os.path.basename(urlparse.urlparse(image_url).path)
-      mime_type = resp.info().gettype()
-      logging.info('Sending uploadFile: %s %s', mime_type, filename)
-      upload = xmlrpc.upload_file(filename, mime_type, data)
-      image['url'] = upload['url']
+      def upload_file(media):
+        logging.info('Sending uploadFile: %s %s', media.mime_type, filename)
+        return xmlrpc.upload_file(filename, media.mime_type, media.data)['url']
+      image['url'] = mediacache.upload(self, image_url, upload_file)
 
     # post!
     # http://codex.wordpress.org/XML-RPC_WordPress_API/Posts#wp.newPost
@@ -120,11 +158,33 @@ class WordPress(models.Destination):
       # WP post tags are now implemented as taxonomies:
       # http://codex.wordpress.org/XML-RPC_WordPress_API/Categories_%26_Tags
       'terms_names': {'post_tag': POST_TAGS},
+      'custom_fields': [{'key': self.MARKER_FIELD,
+                         'value': self.published_marker(post)}],
       }
     logging.info('Sending newPost: %r', new_post_params)
     post_id = xmlrpc.new_post(new_post_params)
     return str(post_id)
 
+  def fetch_published(self):
+    """Fetches the markers in all posts' custom fields with wp.getPosts.
+
+    Returns: dict mapping marker to string WordPress post id
+    """
+    xmlrpc = self.xmlrpc()
+    published = {}
+    offset = 0
+    while True:
+      posts = xmlrpc.get_posts({'number': self.GET_POSTS_PAGE_SIZE,
+                                'offset': offset},
+                               ['post_id', 'custom_fields'])
+      for post in posts:
+        for field in post.get('custom_fields', []):
+          if field.get('key') == self.MARKER_FIELD:
+            published[field['value']] = str(post['post_id'])
+      if len(posts) < self.GET_POSTS_PAGE_SIZE:
+        return published
+      offset += len(posts)
+
   def publish_comment(self, comment):
     """Publishes a comment.
 
@@ -134,36 +194,126 @@ class WordPress(models.Destination):
     Returns: string, the WordPress comment id
     """
     obj = comment.to_activity()['object']
-    author = obj.get('author', {})
-    content = obj.get('content')
-    if not content:
+    params = self.new_comment_params(comment)
+    if not params:
       logging.warning('Skipping empty comment %s', obj['id'])
       return
 
     logging.info('Publishing comment %s', obj['id'])
-    xmlrpc = XmlRpc(self.xmlrpc_url(), self.blog_id, self.username, self.password,
-                    verbose=True, transport=GAEXMLRPCTransport())
+    xmlrpc = self.xmlrpc()
 
     try:
-      comment_id = xmlrpc.new_comment(comment.dest_post_id, {
-          'author': author.get('displayName', 'Anonymous'),
-          'author_url': author.get('url'),
-          'content': comment.render_html(),
-          })
+      comment_id = xmlrpc.new_comment(comment.dest_post_id, params)
     except xmlrpclib.Fault, e:
       # if it's a dupe, we're done!
-      if not (e.faultCode == 500 and
-              e.faultString.startswith('Duplicate comment detected')):
-        raise
+      if is_duplicate_comment(e):
+        return
+      raise
 
-    published = obj.get('published')
-    if published:
-      date = util.parse_iso8601(published)
+    date = self.comment_date(comment)
+    if date:
       logging.info("Updating comment's time to %s", date)
       xmlrpc.edit_comment(comment_id, {'date_created_gmt': date})
 
     return str(comment_id)
 
+  def publish_comments(self, comments):
+    """Publishes comments in batches, with system.multicall.
+
+    Each batch of up to MULTICALL_SIZE comments takes two requests: one with
+    all of the wp.newComment calls, and one with the wp.editComment calls that
+    set their dates. Each comment succeeds or fails on its own. Like
+    publish_comment(), empty and duplicate comments succeed with no id.
+
+    Takes a rate limiter token for each request, both before the batch's first
+    request, so that its dates are always set. If the rate limiter makes it
+    wait too long, the rest of the comments fail with errors.RateLimited.
+
+    Args:
+      comments: sequence of comment entities, in the order to publish them
+
+    Returns: list with the string WordPress comment id or None for each
+      comment, or the exception it failed with
+    """
+    xmlrpc = self.xmlrpc()
+    results = []
+
+    for i in range(0, len(comments), self.MULTICALL_SIZE):
+      batch = comments[i:i + self.MULTICALL_SIZE]
+      params = [self.new_comment_params(c) for c in batch]
+      calls = [xmlrpc.new_comment_call(c.dest_post_id, p)
+               for c, p in zip(batch, params) if p]
+      if calls:
+        try:
+          # one token for each of the batch's two requests
+          self.wait_for_rate_limit()
+          self.wait_for_rate_limit()
+        except errors.RateLimited, e:
+          results.extend([e] * (len(comments) - i))
+          break
+
+      logging.info('Publishing %d comments', len(calls))
+      try:
+        created = iter(xmlrpc.multicall(calls))
+      except Exception, e:
+        results.extend([e] * len(batch))
+        continue
+
+      batch_results = []
+      edits = []
+      for comment, p in zip(batch, params):
+        result = next(created) if p else None
+        if isinstance(result, xmlrpclib.Fault) and is_duplicate_comment(result):
+          result = None
+        elif result is not None and not isinstance(result, Exception):
+          result = str(result)
+          date = self.comment_date(comment)
+          if date:
+            edits.append(xmlrpc.edit_comment_call(result,
+                                                  {'date_created_gmt': date}))
+        batch_results.append(result)
+
+      if edits:
+        logging.info("Updating %d comments' times", len(edits))
+        # the comments exist, so they're done even if their times aren't fixed
+        try:
+          for fault in xmlrpc.multicall(edits):
+            if isinstance(fault, xmlrpclib.Fault):
+              logging.warning("Couldn't update comment time: %s", fault)
+        except Exception:
+          logging.exception("Couldn't update comment times")
+
+      results.extend(batch_results)
+
+    return results
+
+  @staticmethod
+  def new_comment_params(comment):
+    """Returns the wp.newComment struct for a comment, or None if it's empty."""
+    obj = comment.to_activity()['object']
+    if not obj.get('content'):
+      return None
+
+    author = obj.get('author', {})
+    return {'author': author.get('displayName', 'Anonymous'),
+            'author_url': author.get('url'),
+            'content': comment.render_html(),
+            }
+
+  @staticmethod
+  def comment_date(comment):
+    """Returns a comment's published datetime, or None."""
+    published = comment.to_activity()['object'].get('published')
+    if published:
+      return util.parse_iso8601(published)
+
+
+def is_duplicate_comment(fault):
+  """Returns True if an xmlrpclib.Fault is WordPress's duplicate comment error.
+  """
+  return (fault.faultCode == 500 and
+          fault.faultString.startswith('Duplicate comment detected'))
+
 
 # TODO: unify with other dests, sources?
 class AddWordPress(webapp2.RequestHandler):
@@ -223,6 +373,9 @@ class XmlRpc(object):
     # coerce to string.
     self.proxy = xmlrpclib.ServerProxy(str(url), allow_none=True,
                                        transport=transport, verbose=verbose)
+    self.url = str(url)
+    self.transport = transport
+    self.verbose = verbose
     self.blog_id = blog_id
     self.username = username
     self.password = password
@@ -241,6 +394,21 @@ class XmlRpc(object):
     return self.proxy.wp.newPost(self.blog_id, self.username, self.password,
                                  content)
 
+  @stdout_on
+  def get_posts(self, filter, fields):
+    """Fetches posts.
+
+    Details: http://codex.wordpress.org/XML-RPC_WordPress_API/Posts#wp.getPosts
+
+    Args:
+      filter: dict, see link above for fields, e.g. number and offset
+      fields: list of string field names to return
+
+    Returns: list of post dicts
+    """
+    return self.proxy.wp.getPosts(self.blog_id, self.username, self.password,
+                                  filter, fields)
+
   @stdout_on
   def new_comment(self, post_id, comment):
     """Adds a new comment.
@@ -262,7 +430,32 @@ class XmlRpc(object):
     #
     # note that this requires anonymous commenting to be turned on in wordpress
     # via the xmlrpc_allow_anonymous_comments filter.
-    return self.proxy.wp.newComment(self.blog_id, '', '', post_id, comment)
+    return self.proxy.wp.newComment(*self.new_comment_call(post_id, comment)[1])
+
+  def new_comment_call(self, post_id, comment):
+    """Returns a new_comment() call for multicall()."""
+    return ('wp.newComment', [self.blog_id, '', '', post_id, comment])
+
+  @stdout_on
+  def multicall(self, calls):
+    """Makes multiple calls in one request with system.multicall.
+
+    Details: http://mirrors.talideon.com/articles/multicall.html
+
+    Args:
+      calls: sequence of (string method name, list of params) tuples
+
+    Returns: list with the result for each call, or the xmlrpclib.Fault it
+      failed with
+    """
+    if not calls:
+      return []
+
+    results = self.proxy.system.multicall(
+      [{'methodName': method, 'params': params} for method, params in calls])
+    return [xmlrpclib.Fault(r['faultCode'], r['faultString'])
+            if isinstance(r, dict) else r[0]
+            for r in results]
 
   @stdout_on
   def edit_comment(self, comment_id, comment):
@@ -274,8 +467,13 @@ class XmlRpc(object):
       comment_id: integer, comment id
       comment: dict, see link above for fields
     """
-    return self.proxy.wp.editComment(self.blog_id, self.username, self.password,
-                                     comment_id, comment)
+    return self.proxy.wp.editComment(*self.edit_comment_call(comment_id,
+                                                             comment)[1])
+
+  def edit_comment_call(self, comment_id, comment):
+    """Returns an edit_comment() call for multicall()."""
+    return ('wp.editComment',
+            [self.blog_id, self.username, self.password, comment_id, comment])
 
   @stdout_on
   def upload_file(self, filename, mime_type, data):
@@ -283,37 +481,97 @@ class XmlRpc(object):
 
     Details: http://codex.wordpress.org/XML-RPC_WordPress_API/Media#wp.uploadFile
 
+    Builds the request body with upload_file_request() instead of xmlrpclib,
+    which skips xmlrpclib's intermediate copies of the encoded file. Memory use
+    isn't bounded, though. urlfetch can't stream request payloads, or response
+    bodies from media downloads, so the whole file and the whole request body,
+    about 4/3 its size, are both in memory while it's sent.
+
+    Args:
+      filename: string
+      mime_type: string
+      data: string or file-like object, the file contents (may be binary)
+
+    Returns: dict, the uploaded file's id, file, url, and type
+    """
+    if isinstance(data, basestring):
+      data = StringIO.StringIO(data)
+    body = ''.join(self.upload_file_request(filename, mime_type, data))
+    logging.info('uploading %d bytes', len(body))
+
+    # same as xmlrpclib.ServerProxy, so it matches the rest of the calls
+    scheme, uri = urllib.splittype(self.url)
+    host, handler = urllib.splithost(uri)
+    transport = self.transport
+    if transport is None:
+      transport = (xmlrpclib.SafeTransport() if scheme == 'https'
+                   else xmlrpclib.Transport())
+    return transport.request(host, handler or '/RPC2', body,
+                             verbose=self.verbose)[0]
+
+  def upload_file_request(self, filename, mime_type, data):
+    """Generates a wp.uploadFile request body in chunks.
+
+    Marshals everything but the file contents with xmlrpclib, around a
+    placeholder, then base64 encodes the file contents in UPLOAD_CHUNK_SIZE
+    chunks in its place.
+
     Args:
       filename: string
       mime_type: string
-      data: string, the file contents (may be binary)
+      data: file-like object
+
+    Returns: generator of strings
     """
-    logging.info('uploading %d bytes', len(data))
-    return self.proxy.wp.uploadFile(
-      self.blog_id, self.username, self.password,
-      {'name': filename, 'type': mime_type, 'bits': xmlrpclib.Binary(data)})
+    placeholder = '\0freedom upload placeholder\0'
+    body = xmlrpclib.dumps(
+      (self.blog_id, self.username, self.password,
+       {'name': filename, 'type': mime_type,
+        'bits': xmlrpclib.Binary(placeholder)}),
+      methodname='wp.uploadFile', allow_none=True)
+    prefix, suffix = body.split(base64.encodestring(placeholder))
+
+    yield prefix
+    while True:
+      chunk = data.read(UPLOAD_CHUNK_SIZE)
+      if not chunk:
+        break
+      yield base64.encodestring(chunk)
+    yield suffix
 
 
 class GAEXMLRPCTransport(object):
     """Handles an HTTP transaction to an XML-RPC server.
 
+    Supports HTTP and HTTPS, a urlfetch deadline, and gzipped responses.
+    Stateless, and so thread safe. urlfetch reuses connections across requests
+    to the same host on its own.
+
     From http://brizzled.clapper.org/blog/2008/08/25/making-xmlrpc-calls-from-a-google-app-engine-application/
     """
 
-    def __init__(self):
-        pass
+    def __init__(self, scheme='http', deadline=None):
+        """Args:
+          scheme: string, 'http' or 'https'
+          deadline: integer seconds, passed to urlfetch
+        """
+        self.scheme = scheme
+        self.deadline = deadline
 
     def request(self, host, handler, request_body, verbose=0):
         result = None
-        url = 'http://%s%s' % (host, handler)
+        url = '%s://%s%s' % (self.scheme, host, handler)
         try:
             response = urlfetch.fetch(url,
                                       payload=request_body,
                                       method=urlfetch.POST,
-                                      headers={'Content-Type': 'text/xml'})
-        except:
+                                      headers={'Content-Type': 'text/xml',
+                                               'Accept-Encoding': 'gzip'},
+                                      deadline=self.deadline,
+                                      validate_certificate=self.scheme == 'https')
+        except urlfetch.Error:
             msg = 'Failed to fetch %s' % url
-            logging.error(msg)
+            logging.exception(msg)
             raise xmlrpclib.ProtocolError(host + handler, 500, msg, {})
 
         if response.status_code != 200:
@@ -324,7 +582,10 @@ class GAEXMLRPCTransport(object):
                                           "",
                                           response.headers)
         else:
-            result = self.__parse_response(response.content)
+            content = response.content
+            if response.headers.get('Content-Encoding') == 'gzip':
+                content = gzip.GzipFile(fileobj=StringIO.StringIO(content)).read()
+            result = self.__parse_response(content)
 
         return result
 
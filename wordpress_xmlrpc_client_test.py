@@ -0,0 +1,164 @@
+#!/usr/bin/python
+"""Unit tests for the XML-RPC client in wordpress_xmlrpc.py, and for
+WordPress.publish_comments(), which uses it.
+"""
+
+__author__ = ['Ryan Barrett <freedom@ryanb.org>']
+
+import collections
+import gzip
+import os
+import StringIO
+import xmlrpclib
+
+import errors
+import wordpress_xmlrpc
+from wordpress_xmlrpc import GAEXMLRPCTransport, WordPress, XmlRpc
+from webutil import testutil
+
+from google.appengine.api import urlfetch
+
+FakeResponse = collections.namedtuple('FakeResponse',
+                                      ('status_code', 'content', 'headers'))
+FakeComment = collections.namedtuple('FakeComment', ('id', 'dest_post_id'))
+
+
+class UploadFileTest(testutil.HandlerTest):
+
+  def setUp(self):
+    super(UploadFileTest, self).setUp()
+    self.transport = self.mox.CreateMock(xmlrpclib.Transport)
+    self.xmlrpc = XmlRpc('http://my/xmlrpc', 999, 'me', 'passwd',
+                         transport=self.transport)
+
+  def expected_request(self, data):
+    return xmlrpclib.dumps(
+      (999, 'me', 'passwd',
+       {'name': 'pic.jpg', 'type': 'image/jpeg',
+        'bits': xmlrpclib.Binary(data)}),
+      methodname='wp.uploadFile', allow_none=True)
+
+  def test_upload_file_request_matches_xmlrpclib(self):
+    chunk = wordpress_xmlrpc.UPLOAD_CHUNK_SIZE
+    for size in (0, 1, 56, 57, 58, chunk - 1, chunk, chunk + 1, 58373,
+                 300000):
+      data = os.urandom(size)
+      request = ''.join(self.xmlrpc.upload_file_request(
+          'pic.jpg', 'image/jpeg', StringIO.StringIO(data)))
+      self.assertEqual(self.expected_request(data), request,
+                       'Mismatch for %d bytes' % size)
+
+  def test_upload_file(self):
+    data = os.urandom(1000)
+    upload = {'id': '1', 'url': 'http://my/pic.jpg'}
+    self.transport.request('my', '/xmlrpc', self.expected_request(data),
+                           verbose=0).AndReturn((upload,))
+    self.mox.ReplayAll()
+
+    self.assertEqual(upload,
+                     self.xmlrpc.upload_file('pic.jpg', 'image/jpeg', data))
+
+  def test_upload_file_host_and_handler(self):
+    for url, host, handler in (
+        ('http://my/xmlrpc.php?foo=bar', 'my', '/xmlrpc.php?foo=bar'),
+        ('http://me:pw@my:8080/xmlrpc', 'me:pw@my:8080', '/xmlrpc'),
+        ('http://my', 'my', '/RPC2')):
+      xmlrpc = XmlRpc(url, 999, 'me', 'passwd', transport=self.transport)
+      self.transport.request(host, handler, self.expected_request('x'),
+                             verbose=0).AndReturn(({},))
+      self.mox.ReplayAll()
+      xmlrpc.upload_file('pic.jpg', 'image/jpeg', 'x')
+      self.mox.VerifyAll()
+      self.mox.ResetAll()
+
+
+class GAEXMLRPCTransportTest(testutil.HandlerTest):
+
+  def setUp(self):
+    super(GAEXMLRPCTransportTest, self).setUp()
+    self.mox.StubOutWithMock(urlfetch, 'fetch')
+    self.result = ({'url': 'http://my/pic.jpg'},)
+    self.response = xmlrpclib.dumps(self.result, methodresponse=True)
+
+  def expect_fetch(self, url, deadline=None):
+    return urlfetch.fetch(url, payload='body', method=urlfetch.POST,
+                          headers={'Content-Type': 'text/xml',
+                                   'Accept-Encoding': 'gzip'},
+                          deadline=deadline,
+                          validate_certificate=url.startswith('https'))
+
+  def test_http(self):
+    self.expect_fetch('http://my/xmlrpc').AndReturn(
+      FakeResponse(200, self.response, {}))
+    self.mox.ReplayAll()
+    self.assertEqual(self.result,
+                     GAEXMLRPCTransport().request('my', '/xmlrpc', 'body'))
+
+  def test_https_and_deadline(self):
+    self.expect_fetch('https://my/xmlrpc', deadline=60).AndReturn(
+      FakeResponse(200, self.response, {}))
+    self.mox.ReplayAll()
+    transport = GAEXMLRPCTransport(scheme='https', deadline=60)
+    self.assertEqual(self.result, transport.request('my', '/xmlrpc', 'body'))
+
+  def test_gzip(self):
+    compressed = StringIO.StringIO()
+    with gzip.GzipFile(fileobj=compressed, mode='wb') as f:
+      f.write(self.response)
+    self.expect_fetch('http://my/xmlrpc').AndReturn(
+      FakeResponse(200, compressed.getvalue(), {'Content-Encoding': 'gzip'}))
+    self.mox.ReplayAll()
+    self.assertEqual(self.result,
+                     GAEXMLRPCTransport().request('my', '/xmlrpc', 'body'))
+
+  def test_http_error(self):
+    self.expect_fetch('http://my/xmlrpc').AndReturn(FakeResponse(503, '', {}))
+    self.mox.ReplayAll()
+    with self.assertRaises(xmlrpclib.ProtocolError) as cm:
+      GAEXMLRPCTransport().request('my', '/xmlrpc', 'body')
+    self.assertEqual(503, cm.exception.errcode)
+
+  def test_fetch_error(self):
+    self.expect_fetch('http://my/xmlrpc').AndRaise(urlfetch.DownloadError())
+    self.mox.ReplayAll()
+    with self.assertRaises(xmlrpclib.ProtocolError) as cm:
+      GAEXMLRPCTransport().request('my', '/xmlrpc', 'body')
+    self.assertEqual(500, cm.exception.errcode)
+
+
+class PublishCommentsTest(testutil.HandlerTest):
+
+  def setUp(self):
+    super(PublishCommentsTest, self).setUp()
+    self.wp = WordPress(key_name='http://my/xmlrpc', blog_id=999,
+                        username='me', password='passwd')
+    self.xmlrpc = XmlRpc('http://my/xmlrpc', 999, 'me', 'passwd')
+    self.mox.stubs.Set(WordPress, 'xmlrpc', lambda wp: self.xmlrpc)
+    self.mox.stubs.Set(WordPress, 'new_comment_params',
+                       staticmethod(lambda c: {'content': c.id}))
+    self.mox.stubs.Set(WordPress, 'comment_date', staticmethod(lambda c: None))
+    self.mox.StubOutWithMock(self.xmlrpc, 'multicall')
+
+  def test_rate_limit_token_per_request(self):
+    self.mox.stubs.Set(WordPress, 'MULTICALL_SIZE', 1)
+    waits = []
+
+    def wait_for_rate_limit(wp):
+      waits.append(wp)
+      if len(waits) > 2:
+        raise errors.RateLimited('Rate limited', 5)
+
+    self.mox.stubs.Set(WordPress, 'wait_for_rate_limit', wait_for_rate_limit)
+    self.xmlrpc.multicall(
+      [('wp.newComment', [999, '', '', 'post', {'content': '1'}])]
+      ).AndReturn([5])
+    self.mox.ReplayAll()
+
+    results = self.wp.publish_comments([FakeComment('1', 'post'),
+                                        FakeComment('2', 'post'),
+                                        FakeComment('3', 'post')])
+    # two tokens for the first batch's requests, then rate limited
+    self.assertEqual(3, len(waits))
+    self.assertEqual('5', results[0])
+    self.assertIsInstance(results[1], errors.RateLimited)
+    self.assertIsInstance(results[2], errors.RateLimited)